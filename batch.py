@@ -0,0 +1,271 @@
+#!/usr/local/bin/python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import os
+import cv2
+import glob
+import json
+import time
+import logging
+import argparse
+import traceback
+import collections
+import multiprocessing
+import numpy as np
+import board
+import pieces
+import solver
+import solutions
+import solution_db
+import matching
+
+IMAGE_PATTERNS = ["*.png", "*.jpg", "*.jpeg"]
+
+# The Worker of this process
+worker = None
+
+
+def Filenames(patterns):
+  """Returns the images in the given directories or matching the globs"""
+  filenames = []
+  for pattern in patterns:
+    if os.path.isdir(pattern):
+      matches = [f for p in IMAGE_PATTERNS
+                 for f in glob.glob(os.path.join(pattern, p))]
+    else:
+      matches = glob.glob(pattern)
+    if not matches:
+      logging.warning("No images found in {0}".format(pattern))
+    filenames += sorted(matches)
+  return filenames
+
+
+def Location(location):
+  """Returns a JSON friendly (piece, orientation, i, j) of a placement"""
+  placement = pieces.FindPlacement(location)
+  return [placement.piece_type.name, placement.orientation, placement.i,
+          placement.j]
+
+
+def Board(puzzle, constraints):
+  """Returns a JSON friendly detected board: the SquareType names of the
+  puzzle's squares, and the Constraint names or None of every cell"""
+  values = board.InnerSquares(puzzle)
+  return collections.OrderedDict([
+      ("puzzle", [[board.SquareType(v).name for v in values[i:i + 4]]
+                  for i in range(0, len(values), 4)]),
+      ("constraints", [[c.name if c else None for c in row]
+                       for row in constraints])
+  ])
+
+
+class Worker(object):
+  """Runs the solver's pipeline on image files.
+
+  The solutions DB is memory mapped, so all the workers share its pages."""
+
+  def __init__(self, db_filename, cell_size=matching.CELL_SIZE,
+               max_mismatches=0, coarse_width=solver.COARSE_WIDTH,
+               params=solver.DEFAULT_PARAMS):
+    self.db = solution_db.SolutionDB(db_filename)
+    self.matcher = matching.TemplateMatcher(solver.LoadTemplates(), 1,
+                                            cell_size)
+    self.max_mismatches = max_mismatches
+    self.coarse_width = coarse_width
+    self.params = params
+    self.partial_index = None
+
+  def Solve(self, filename, data=None):
+    """Returns the result of solving the image in filename as a dict.
+
+    If data is given it is the encoded image, and filename only names it."""
+    result = collections.OrderedDict([("image", filename)])
+    timings = collections.OrderedDict()
+    result["timings"] = timings
+    start = last = time.time()
+
+    def Timed(stage):
+      now = time.time()
+      timings[stage] = round((now - last) * 1000, 3)
+      return now
+
+    if data is None:
+      frame = cv2.imread(filename)
+    else:
+      frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                           cv2.IMREAD_COLOR)
+    last = Timed("read")
+    if frame is None:
+      result["error"] = "Could not read image"
+      return result
+
+    if self.coarse_width:
+      frame_bw = solver.PrepareCard(frame, self.coarse_width,
+                                    params=self.params)
+    else:
+      frame_bw = solver.PrepareImage(frame, self.params)
+    last = Timed("prepare")
+
+    box = solver.FindBoard(frame_bw, self.params)
+    last = Timed("find_board")
+    if not box:
+      result["error"] = "Board not found"
+      return result
+    result["box"] = list(box)
+
+    cells = solver.ReadCells(frame_bw, box)
+    objects, scores, constraints = solver.Recognize(self.matcher, cells,
+                                                    params=self.params)
+    puzzle = solver.BuildPuzzleBoardFromObjects(objects)
+    last = Timed("recognize")
+
+    result.update(Board(puzzle, constraints))
+
+    masks = solver.ConstraintMasks(constraints)
+    matches = solutions.Lookup(self.db, puzzle, *masks)
+    result["exact"] = bool(matches)
+    if not matches and self.max_mismatches:
+      if not self.partial_index:
+        self.partial_index = solutions.PartialIndex(self.db)
+      matches = self.partial_index.Lookup(puzzle, scores, self.max_mismatches,
+                                          *masks)
+    last = Timed("lookup")
+
+    result["solutions"] = [[Location(l) for l in m] for m in matches]
+    timings["total"] = round((last - start) * 1000, 3)
+    return result
+
+
+def InitWorker(*args):
+  global worker
+  worker = Worker(*args)
+
+
+def Solve(filename, data=None):
+  try:
+    return worker.Solve(filename, data)
+  except Exception, e:
+    logging.error(traceback.format_exc())
+    return collections.OrderedDict([("image", filename), ("error", str(e))])
+
+
+def SolveData(image):
+  """Solves a (name, encoded image) pair"""
+  return Solve(*image)
+
+
+def SolveAll(filenames, found, jobs=1, worker_args=()):
+  """Calls found with the result of every image, in order.
+
+  With jobs > 1 the images are solved by a process pool. Each process
+  builds a Worker with worker_args."""
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs, InitWorker, worker_args)
+    try:
+      for result in pool.imap(Solve, filenames):
+        found(result)
+    finally:
+      pool.terminate()
+  else:
+    InitWorker(*worker_args)
+    for filename in filenames:
+      found(Solve(filename))
+
+
+def main():
+  try:
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images",
+                        nargs="+",
+                        help="Directories or globs of images to solve")
+    parser.add_argument("--db",
+                        type=str,
+                        default=solution_db.DB_FILENAME,
+                        help="Solutions database file")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of processes to solve with")
+    parser.add_argument("--output",
+                        type=str,
+                        help="File to write the JSON lines to, instead of "
+                        "stdout")
+    parser.add_argument("--cell_size",
+                        type=int,
+                        default=matching.CELL_SIZE,
+                        help="Size to downscale larger cells to before "
+                        "matching. 0 matches cells as they are")
+    parser.add_argument("--max_mismatches",
+                        type=int,
+                        default=0,
+                        help="Squares a solution may differ from the detected "
+                        "board in, when there is no exact solution")
+    parser.add_argument("--coarse_width",
+                        type=int,
+                        default=solver.COARSE_WIDTH,
+                        help="Width to downscale images to when locating the "
+                        "card. 0 preprocesses the whole image")
+    parser.add_argument("--config",
+                        type=str,
+                        help="JSON file of detection parameters, as written "
+                        "by tune.py")
+    parser.add_argument("-v",
+                        "--verbose",
+                        action="store_true",
+                        help="Enable debug prints")
+
+    args = parser.parse_args()
+    if args.verbose:
+      logging.getLogger('').handlers = []
+      logging.basicConfig(level=logging.DEBUG)
+
+    params = solver.DEFAULT_PARAMS
+    if args.config:
+      params = solver.LoadParams(args.config)
+    filenames = Filenames(args.images)
+    output = open(args.output, "w") if args.output else sys.stdout
+    counts = collections.Counter()
+    start = time.time()
+
+    def Found(result):
+      counts["images"] += 1
+      if result.get("solutions"):
+        counts["solved"] += 1
+      output.write(json.dumps(result) + "\n")
+      output.flush()
+
+    try:
+      SolveAll(filenames, Found, args.jobs,
+               (args.db, args.cell_size, args.max_mismatches,
+                args.coarse_width, params))
+    finally:
+      if args.output:
+        output.close()
+
+    elapsed = time.time() - start
+    logging.info("Solved {0} of {1} images in {2:.1f}s ({3:.1f} images/s)".
+                 format(counts["solved"], counts["images"], elapsed,
+                        counts["images"] / max(elapsed, 1e-6)))
+
+  except Exception, e:
+    logging.error(traceback.format_exc())
+    return e
+
+
+if __name__ == "__main__":
+  sys.exit(main())
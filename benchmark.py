@@ -0,0 +1,275 @@
+#!/usr/local/bin/python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import os
+import cv2
+import glob
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import traceback
+import collections
+import multiprocessing
+import numpy as np
+import solver
+import solutions
+import solution_db
+import matching
+
+SAMPLES = ["samples/radar*.png", "samples/planes*.png"]
+BASELINE_FILENAME = "benchmark.json"
+PERCENTILES = [50, 90, 99]
+
+# Stages this much slower than the baseline's median are regressions
+TOLERANCE = 0.2
+
+# Differences in medians below this many ms are noise
+MIN_DIFFERENCE_MS = 0.05
+
+
+class Timings(object):
+  """Collects how long every call of every stage took"""
+
+  def __init__(self):
+    self.samples = collections.OrderedDict()
+
+  def Time(self, stage, f, *args):
+    start = time.time()
+    result = f(*args)
+    self.samples.setdefault(stage, []).append(time.time() - start)
+    return result
+
+  def Summary(self):
+    """Returns the count, mean and percentiles in ms of every stage"""
+    summary = collections.OrderedDict()
+    for stage, samples in self.samples.iteritems():
+      ms = np.array(samples) * 1000
+      summary[stage] = collections.OrderedDict(
+          [("count", len(ms)), ("mean", ms.mean()), ("min", ms.min())] +
+          [("p{0}".format(p), np.percentile(ms, p)) for p in PERCENTILES])
+    return summary
+
+
+def BenchmarkSamples(timings, filenames, repeat, db, threads, cell_size,
+                     coarse_width):
+  """Times every stage of the solver's pipeline on the sample images.
+
+  Returns the images where preprocessing only the card finds a different
+  board than preprocessing the whole frame."""
+  templates = solver.LoadTemplates()
+  matcher = matching.TemplateMatcher(templates, threads, cell_size)
+  renderer = solver.Renderer(solver.LoadImages())
+  mismatches = set()
+  try:
+    for _ in range(repeat):
+      for filename in filenames:
+        frame = timings.Time("read", cv2.imread, filename)
+        frame_bw = timings.Time("prepare", solver.PrepareImage, frame)
+        box = timings.Time("find_board", solver.FindBoard, frame_bw)
+        if coarse_width:
+          card_bw = timings.Time("prepare_card", solver.PrepareCard, frame,
+                                 coarse_width)
+          if solver.FindBoard(card_bw) != box:
+            mismatches.add(filename)
+        if not box:
+          logging.warning("No board found in {0}".format(filename))
+          continue
+
+        cells = timings.Time("read_cells", solver.ReadCells, frame_bw, box)
+        objects = timings.Time("detect_objects", solver.DetectObjects,
+                               templates, cells)
+        constraints = timings.Time("detect_constraints",
+                                   solver.DetectConstraints, templates, cells)
+        timings.Time("recognize", solver.Recognize, matcher, cells)
+
+        puzzle = solver.BuildPuzzleBoardFromObjects(objects)
+        matches = timings.Time("lookup", solutions.Lookup, db, puzzle)
+        matches = timings.Time("pass_constraints", lambda: [
+            m for m in matches if solver.PassConstraints(constraints, m)])
+        timings.Time("constrained_lookup", solutions.Lookup, db, puzzle,
+                     *solver.ConstraintMasks(constraints))
+        timings.Time("direct_solve", solutions.SolvePuzzle, puzzle,
+                     *solver.ConstraintMasks(constraints))
+        for m in matches:
+          timings.Time("render", renderer.Render, m, frame, box)
+  finally:
+    matcher.Close()
+  return mismatches
+
+
+def BenchmarkDB(timings, filename, repeat):
+  for _ in range(repeat):
+    timings.Time("db_load", solution_db.SolutionDB, filename)
+
+
+def BenchmarkBuild(timings, repeat, jobs):
+  """Times finding all solutions and building a DB from them"""
+  tmp = tempfile.mkdtemp()
+  try:
+    raw = os.path.join(tmp, solutions.RAW_FILENAME)
+    db = os.path.join(tmp, solution_db.DB_FILENAME)
+    for _ in range(repeat):
+      timings.Time("find_all_solutions", solutions.FindAllSolutions, None,
+                   jobs)
+    with solution_db.RecordWriter(raw) as writer:
+      solutions.FindAllSolutions(writer.Append, jobs)
+    for _ in range(repeat):
+      timings.Time("build_hashable_solutions",
+                   solutions.BuildHashableSolutions, raw, db, jobs)
+  finally:
+    shutil.rmtree(tmp)
+
+
+def Compare(summary, baseline, tolerance=TOLERANCE):
+  """Returns the stages whose median is slower than in the baseline"""
+  regressions = []
+  for stage, stats in summary.iteritems():
+    if stage not in baseline:
+      continue
+    before, after = baseline[stage]["p50"], stats["p50"]
+    if after > before * (1 + tolerance) and after - before > MIN_DIFFERENCE_MS:
+      regressions.append((stage, before, after))
+  return regressions
+
+
+def Print(summary, baseline):
+  columns = ["count", "mean", "min"] + ["p{0}".format(p) for p in PERCENTILES]
+  print "{0:<26}".format("stage (ms)") + "".join("{0:>10}".format(c)
+                                                 for c in columns) + \
+      "{0:>10}".format("vs p50")
+  for stage, stats in summary.iteritems():
+    line = "{0:<26}{1:>10}".format(stage, stats["count"])
+    line += "".join("{0:>10.2f}".format(stats[c]) for c in columns[1:])
+    if stage in baseline and baseline[stage]["p50"]:
+      line += "{0:>+10.0%}".format(stats["p50"] / baseline[stage]["p50"] - 1)
+    print line
+
+
+def main():
+  try:
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples",
+                        nargs="+",
+                        default=SAMPLES,
+                        help="Globs of images to run the pipeline on")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=10,
+                        help="Times to run every sample through the pipeline")
+    parser.add_argument("--build_repeat",
+                        type=int,
+                        default=1,
+                        help="Times to find all solutions and build the DB. 0 "
+                        "skips them")
+    parser.add_argument("--db",
+                        type=str,
+                        default=solution_db.DB_FILENAME,
+                        help="Solutions database file")
+    parser.add_argument("--threads",
+                        type=int,
+                        help="Number of threads matching templates")
+    parser.add_argument("--cell_size",
+                        type=int,
+                        default=matching.CELL_SIZE,
+                        help="Size to downscale larger cells to before "
+                        "matching")
+    parser.add_argument("--coarse_width",
+                        type=int,
+                        default=solver.COARSE_WIDTH,
+                        help="Width to locate the card at when preprocessing "
+                        "only the card. 0 skips it")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="Number of processes to find solutions with")
+    parser.add_argument("--baseline",
+                        type=str,
+                        default=BASELINE_FILENAME,
+                        help="Baseline to compare against")
+    parser.add_argument("--save",
+                        action="store_true",
+                        help="Store the results as the new baseline")
+    parser.add_argument("--tolerance",
+                        type=float,
+                        default=TOLERANCE,
+                        help="Slowdown of a stage's median that is a "
+                        "regression")
+    parser.add_argument("-v",
+                        "--verbose",
+                        action="store_true",
+                        help="Enable debug prints")
+
+    args = parser.parse_args()
+    if args.verbose:
+      logging.getLogger('').handlers = []
+      logging.basicConfig(level=logging.DEBUG)
+
+    filenames = [f for pattern in args.samples
+                 for f in sorted(glob.glob(pattern))]
+    assert filenames, "No sample images found"
+
+    timings = Timings()
+    BenchmarkDB(timings, args.db, args.repeat)
+    mismatches = BenchmarkSamples(timings, filenames, args.repeat,
+                                  solution_db.SolutionDB(args.db),
+                                  args.threads, args.cell_size,
+                                  args.coarse_width)
+    if args.build_repeat:
+      BenchmarkBuild(timings, args.build_repeat, args.jobs)
+    summary = timings.Summary()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+      with open(args.baseline) as f:
+        baseline = json.load(f)["stages"]
+    Print(summary, baseline)
+    for filename in sorted(mismatches):
+      logging.warning("Preprocessing only the card finds a different board "
+                      "in {0}".format(filename))
+
+    regressions = Compare(summary, baseline, args.tolerance)
+    for stage, before, after in regressions:
+      logging.warning("{0} regressed: median {1:.2f}ms -> {2:.2f}ms".format(
+          stage, before, after))
+
+    if args.save:
+      with open(args.baseline, "w") as f:
+        json.dump(collections.OrderedDict([
+            ("machine", platform.platform()),
+            ("cpus", multiprocessing.cpu_count()),
+            ("opencv", cv2.__version__),
+            ("samples", filenames),
+            ("repeat", args.repeat),
+            ("stages", summary),
+        ]), f, indent=2)
+      logging.info("Saved baseline to {0}".format(args.baseline))
+
+    if regressions:
+      return "{0} stages regressed".format(len(regressions))
+
+  except Exception, e:
+    logging.error(traceback.format_exc())
+    return e
+
+
+if __name__ == "__main__":
+  sys.exit(main())
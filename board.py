@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import numpy as np
+import operator
 from enum import Enum
 
 
@@ -46,6 +47,128 @@ def IsSolved(board):
           all(board[:, 5] == np.array([SquareType.AIR] * 6)))
 
 
+# Bitboard representation. Square (i, j) of the 6x6 board is bit 6 * i + j.
+# A bitboard is a tuple with one occupancy mask per SquareType, indexed by
+# SquareType.value. AIR squares are the ones not covered by any other mask.
+def Bit(i, j):
+  return 1 << (6 * i + j)
+
+
+ALL = (1 << 36) - 1
+INNER_SQUARES = [(i, j) for i in range(1, 5) for j in range(1, 5)]
+INNER = sum(Bit(i, j) for i, j in INNER_SQUARES)
+BORDER = ALL & ~INNER
+ARROWS = (SquareType.UP, SquareType.RIGHT, SquareType.DOWN, SquareType.LEFT)
+
+
+def EmptyBits():
+  return (0,) * len(SquareType)
+
+
+def Occupied(bits):
+  """Returns mask of all the squares that are not AIR"""
+  return reduce(operator.or_, bits[1:])
+
+
+def IsSolvedBits(bits):
+  return not Occupied(bits) & BORDER
+
+
+def RemoveGlass(bits):
+  glass = SquareType.GLASS.value
+  return bits[:glass] + (0,) + bits[glass + 1:]
+
+
+def AnyOrientation(bits):
+  """Replaces all plane orientations with ANY"""
+  arrows = reduce(operator.or_, [bits[a.value] for a in ARROWS])
+  any_bits = list(bits)
+  for a in ARROWS:
+    any_bits[a.value] = 0
+  any_bits[SquareType.ANY.value] |= arrows
+  return tuple(any_bits)
+
+
+def Squares(bits):
+  """Yields ((i, j), square_type) for every square that is not AIR"""
+  for square_type in SquareType:
+    mask = bits[square_type.value]
+    if square_type is SquareType.AIR or not mask:
+      continue
+    for n in range(36):
+      if mask >> n & 1:
+        yield divmod(n, 6), square_type
+
+
+# _ROTATED_ROWS[i][row] is the mask of row i (given as 6 bits) after rotating
+# the board 90deg clock wise.
+_ROTATED_ROWS = [[sum(Bit(j, 5 - i) for j in range(6) if row >> j & 1)
+                  for row in range(64)] for i in range(6)]
+
+
+def RotateMask(mask, times=1):
+  """Rotates the squares of mask times * 90deg clock wise"""
+  for _ in range(times % 4):
+    mask = (_ROTATED_ROWS[0][mask & 63] | _ROTATED_ROWS[1][mask >> 6 & 63] |
+            _ROTATED_ROWS[2][mask >> 12 & 63] |
+            _ROTATED_ROWS[3][mask >> 18 & 63] |
+            _ROTATED_ROWS[4][mask >> 24 & 63] | _ROTATED_ROWS[5][mask >> 30])
+  return mask
+
+
+def Rotate(bits, times=1):
+  """Rotates the board times * 90deg clock wise, planes included"""
+  rotated = [RotateMask(mask, times) for mask in bits]
+  arrows = [rotated[a.value] for a in ARROWS]
+  for k, a in enumerate(ARROWS):
+    rotated[a.value] = arrows[(k - times) % 4]
+  return tuple(rotated)
+
+
+def InnerSquares(bits):
+  """Returns the SquareType values of the inner squares, row by row"""
+  values = [SquareType.AIR.value] * len(INNER_SQUARES)
+  for (i, j), square_type in Squares(bits):
+    values[(i - 1) * 4 + j - 1] = square_type.value
+  return values
+
+
+# _ROW_DIGITS[i][row] is the value of the inner squares of row i + 1 (given as
+# 4 bits) as base 7 digits. Inner square n, row by row, is digit n.
+_ROW_DIGITS = [[sum(7**(4 * i + j) for j in range(4) if row >> j & 1)
+                for row in range(16)] for i in range(4)]
+
+
+def Key(bits):
+  """Returns the inner squares as a base 7 number, digit n is square n's
+  SquareType value. The key is the same on every platform and version."""
+  key = 0
+  for value in range(1, len(bits)):
+    mask = bits[value]
+    if mask:
+      key += value * (_ROW_DIGITS[0][mask >> 7 & 15] + _ROW_DIGITS[1][
+          mask >> 13 & 15] + _ROW_DIGITS[2][mask >> 19 & 15] + _ROW_DIGITS[3][
+              mask >> 25 & 15])
+  return key
+
+
+def ToBits(board):
+  bits = [0] * len(SquareType)
+  for i in range(board.shape[0]):
+    for j in range(board.shape[1]):
+      bits[board[i, j].value] |= Bit(i, j)
+  bits[SquareType.AIR.value] = 0
+  return tuple(bits)
+
+
+def FromBits(bits):
+  """Converts bitboard back to a 6x6 board, e.g. for printing"""
+  board = Empty()
+  for square, square_type in Squares(bits):
+    board[square] = square_type
+  return board
+
+
 def Print(board):
   for i in range(6):
     for j in range(6):
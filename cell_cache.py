@@ -0,0 +1,79 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import cv2
+import logging
+import collections
+import numpy as np
+
+
+def Fingerprint(image, size=16):
+  """Returns a size * size bits perceptual hash of the image.
+
+  Bits are set where the image, downscaled to size x size, is brighter than
+  its mean."""
+  small = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+  return int(np.packbits(small > small.mean()).tostring().encode("hex"), 16)
+
+
+def HammingDistance(a, b):
+  return bin(a ^ b).count("1")
+
+
+class CellCache(object):
+  """Remembers what was recognized in every cell, by the cell's fingerprint.
+
+  A cell is recognized again only when its fingerprint is more than
+  max_distance bits away from the one it had when last recognized."""
+
+  def __init__(self, max_distance=24):
+    self.max_distance = max_distance
+    self.cells = {}
+    self.hits = 0
+    self.misses = 0
+
+  def Get(self, key, fingerprint):
+    """Returns the result cached for key, or None if the cell changed"""
+    cached = self.cells.get(key)
+    if cached and HammingDistance(cached[0],
+                                  fingerprint) <= self.max_distance:
+      self.hits += 1
+      return cached[1]
+    self.misses += 1
+    return None
+
+  def Put(self, key, fingerprint, result):
+    self.cells[key] = (fingerprint, result)
+
+
+class LRUCache(object):
+  """Keeps the size most recently used items"""
+
+  def __init__(self, size=64):
+    self.size = size
+    self.items = collections.OrderedDict()
+
+  def Get(self, key, default=None):
+    if key not in self.items:
+      return default
+    value = self.items.pop(key)
+    self.items[key] = value
+    return value
+
+  def Put(self, key, value):
+    self.items.pop(key, None)
+    self.items[key] = value
+    if len(self.items) > self.size:
+      evicted, _ = self.items.popitem(last=False)
+      logging.debug("Evicted {0} from cache".format(evicted))
@@ -0,0 +1,118 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class DancingLinks(object):
+  """Knuth's Algorithm X, implemented with dancing links.
+
+  Finds all sets of rows that cover every column exactly once. Each row is a
+  list of column numbers in range(num_columns). The links are kept in flat
+  lists indexed by node number. Node 0 is the root, node c + 1 the header of
+  column c."""
+
+  def __init__(self, num_columns, rows):
+    headers = num_columns + 1
+    self.left = [(i - 1) % headers for i in range(headers)]
+    self.right = [(i + 1) % headers for i in range(headers)]
+    self.up = range(headers)
+    self.down = range(headers)
+    self.column = range(headers)
+    self.row = [None] * headers
+    self.size = [0] * headers
+
+    for r, columns in enumerate(rows):
+      first = len(self.row)
+      for k, c in enumerate(columns):
+        node = first + k
+        header = c + 1
+        self.left.append(first + (k - 1) % len(columns))
+        self.right.append(first + (k + 1) % len(columns))
+        self.up.append(self.up[header])
+        self.down.append(header)
+        self.down[self.up[header]] = node
+        self.up[header] = node
+        self.column.append(header)
+        self.row.append(r)
+        self.size[header] += 1
+
+  def Cover(self, c):
+    left, right, up, down = self.left, self.right, self.up, self.down
+    right[left[c]] = right[c]
+    left[right[c]] = left[c]
+    i = down[c]
+    while i != c:
+      j = right[i]
+      while j != i:
+        down[up[j]] = down[j]
+        up[down[j]] = up[j]
+        self.size[self.column[j]] -= 1
+        j = right[j]
+      i = down[i]
+
+  def Uncover(self, c):
+    left, right, up, down = self.left, self.right, self.up, self.down
+    i = up[c]
+    while i != c:
+      j = left[i]
+      while j != i:
+        self.size[self.column[j]] += 1
+        down[up[j]] = j
+        up[down[j]] = j
+        j = left[j]
+      i = up[i]
+    right[left[c]] = c
+    left[right[c]] = c
+
+  def Solutions(self):
+    """Yields every exact cover as a list of row numbers"""
+    solution = []
+
+    def Search():
+      if self.right[0] == 0:
+        yield list(solution)
+        return
+
+      # Branch on the column with the fewest rows left. A column no row can
+      # cover anymore ends this branch right away.
+      c = self.right[0]
+      best = c
+      while c != 0:
+        if self.size[c] < self.size[best]:
+          best = c
+        c = self.right[c]
+      if not self.size[best]:
+        return
+
+      self.Cover(best)
+      r = self.down[best]
+      while r != best:
+        solution.append(self.row[r])
+        j = self.right[r]
+        while j != r:
+          self.Cover(self.column[j])
+          j = self.right[j]
+
+        for found in Search():
+          yield found
+
+        j = self.left[r]
+        while j != r:
+          self.Uncover(self.column[j])
+          j = self.left[j]
+        solution.pop()
+        r = self.down[r]
+      self.Uncover(best)
+
+    return Search()
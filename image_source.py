@@ -12,10 +12,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
 import cv2
+import Queue
 import logging
 import glob
-import itertools
+import collections
+import threading
+
+VIDEO_EXTENSIONS = (".avi", ".mp4", ".mov", ".mkv", ".mpg", ".mpeg")
 
 
 class ImageSource(object):
@@ -23,6 +28,9 @@ class ImageSource(object):
   def NextFrame(self):
     raise NotImplemented
 
+  def Close(self):
+    pass
+
 
 class CameraSource(ImageSource):
 
@@ -35,12 +43,144 @@ class CameraSource(ImageSource):
     return frame
 
 
+def IsVideo(filename):
+  return os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS
+
+
+def ReadFrames(filename):
+  """Yields the frames of an image or a video file, decoding them lazily"""
+  if not IsVideo(filename):
+    frame = cv2.imread(filename)
+    if frame is None:
+      logging.warning("Could not read {0}".format(filename))
+    else:
+      yield frame
+    return
+
+  cap = cv2.VideoCapture(filename)
+  try:
+    if not cap.isOpened():
+      logging.warning("Could not open {0}".format(filename))
+    while True:
+      ok, frame = cap.read()
+      if not ok:
+        break
+      yield frame
+  finally:
+    cap.release()
+
+
 class FileSource(ImageSource):
+  """Reads the frames of images and videos matching a glob.
+
+  Frames are decoded on a background thread that stays at most prefetch
+  frames ahead, so memory doesn't grow with the number or length of the
+  files. With loop the files are played over and over, otherwise NextFrame
+  returns None after the last frame. A single still image is decoded once."""
+
+  def __init__(self, filenames, loop=True, prefetch=4):
+    self.filenames = sorted(glob.glob(filenames))
+    assert self.filenames, "No image files specifed"
+    self.loop = loop
+    self.still = None
+    if loop and len(self.filenames) == 1 and not IsVideo(self.filenames[0]):
+      self.still = cv2.imread(self.filenames[0])
+      assert self.still is not None, "Could not read {0}".format(
+          self.filenames[0])
+      return
+
+    self.frames = Queue.Queue(prefetch)
+    self.ended = False
+    self.running = True
+    self.thread = threading.Thread(target=self.Run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Put(self, frame):
+    """Waits for room for frame. Returns False if the source was closed"""
+    while self.running:
+      try:
+        self.frames.put(frame, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
 
-  def __init__(self, filenames):
-    self.frames = [cv2.imread(f) for f in glob.glob(filenames)]
-    assert self.frames, "No image files specifed"
-    self.it = itertools.cycle(self.frames)
+  def Run(self):
+    while True:
+      frames = 0
+      for filename in self.filenames:
+        for frame in ReadFrames(filename):
+          if not self.Put(frame):
+            return
+          frames += 1
+      if not self.loop or not frames:
+        break
+    self.Put(None)
 
   def NextFrame(self):
-    return self.it.next().copy()
+    if self.still is not None:
+      return self.still.copy()
+    if self.ended:
+      return None
+    frame = self.frames.get()
+    self.ended = frame is None
+    return frame
+
+  def Close(self):
+    if self.still is None:
+      self.running = False
+      self.thread.join()
+
+
+class AsyncSource(ImageSource):
+  """Reads frames from another source on a background thread.
+
+  Keeps up to buffer_size of the most recent frames. NextFrame returns the
+  latest one and drops the older ones, so the caller always gets the
+  freshest frame while capture overlaps with processing. A None frame from
+  the source ends the stream. The source's NextFrame should block until a
+  new frame is ready, as a camera's does, or the thread spins copying frames
+  that are dropped."""
+
+  def __init__(self, source, buffer_size=2):
+    self.source = source
+    self.frames = collections.deque(maxlen=buffer_size)
+    self.cond = threading.Condition()
+    self.captured = 0
+    self.dropped = 0
+    self.running = True
+    self.thread = threading.Thread(target=self.Run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Run(self):
+    while self.running:
+      frame = self.source.NextFrame()
+      with self.cond:
+        if frame is None:
+          self.running = False
+        else:
+          if len(self.frames) == self.frames.maxlen:
+            self.dropped += 1
+          self.frames.append(frame)
+          self.captured += 1
+        self.cond.notify()
+
+  def NextFrame(self):
+    with self.cond:
+      while not self.frames and self.running:
+        self.cond.wait()
+      if not self.frames:
+        return None
+      frame = self.frames.pop()
+      self.dropped += len(self.frames)
+      self.frames.clear()
+      return frame
+
+  def Close(self):
+    self.running = False
+    self.thread.join()
+    self.source.Close()
+    logging.info("Captured {0} frames, dropped {1}".format(self.captured,
+                                                          self.dropped))
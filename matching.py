@@ -0,0 +1,141 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import cv2
+import time
+import logging
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Size of the cells the templates were cut from, in pixels
+TEMPLATE_CELL_SIZE = 104
+
+# Larger cells are downscaled to about this size before matching
+CELL_SIZE = TEMPLATE_CELL_SIZE
+
+# Cell sizes are rounded to a multiple of this when scaling templates
+CELL_SIZE_QUANTUM = 8
+
+
+def Resize(image, ratio):
+  h, w = image.shape[:2]
+  return cv2.resize(image, (max(1, int(round(w * ratio))),
+                            max(1, int(round(h * ratio)))),
+                    interpolation=cv2.INTER_AREA
+                    if ratio < 1 else cv2.INTER_LINEAR)
+
+
+class TemplatePyramid(object):
+  """Templates scaled to the size of the cells they are matched against.
+
+  Cells larger than cell_size are downscaled to about cell_size, so close
+  cameras don't cost more matching. Templates are scaled by the ratio of the
+  (downscaled) cells to TEMPLATE_CELL_SIZE, so distant cameras still match.
+  Scaled templates are memoized per cell size, rounded to quantum."""
+
+  def __init__(self, templates, cell_size=CELL_SIZE, quantum=CELL_SIZE_QUANTUM):
+    self.templates = templates
+    self.cell_size = cell_size
+    self.quantum = quantum
+    self.levels = {}
+
+  def Level(self, shape):
+    """Returns the factor to scale cells of shape by, and the templates to
+    match the scaled cells with"""
+    size = max(self.quantum, self.quantum * int(round(
+        (shape[0] + shape[1]) / 2.0 / self.quantum)))
+    if size not in self.levels:
+      scale = min(1.0, float(self.cell_size) / size)
+      ratio = size * scale / TEMPLATE_CELL_SIZE
+      logging.debug("Scaling templates by {0:.2f} for {1}px cells".format(
+          ratio, size))
+      self.levels[size] = (scale, dict(
+          (label, [Resize(t, ratio) for t in templates])
+          for label, templates in self.templates.iteritems()))
+    return self.levels[size]
+
+
+class TemplateMatcher(object):
+  """Matches cells against all the templates in a single pass.
+
+  templates maps a label (object or constraint) to its template images.
+  Cells are matched concurrently on a thread pool; OpenCV releases the GIL
+  while matching, so the threads run in parallel. Unless cell_size is None,
+  cells and templates are first scaled by a TemplatePyramid."""
+
+  def __init__(self, templates, threads=None, cell_size=CELL_SIZE):
+    self.templates = templates
+    self.pyramid = TemplatePyramid(templates, cell_size) if cell_size else None
+    self.pool = ThreadPool(threads or multiprocessing.cpu_count())
+    # Seconds spent matching each label's templates, over all cells
+    self.timings = collections.defaultdict(float)
+    self.cells = 0
+    self.elapsed = 0
+
+  def Scores(self, cell, level=None):
+    """Returns the best score of every label, and the time matching took.
+
+    level is a TemplatePyramid level to scale the cell and templates by."""
+    scores = {}
+    timings = {}
+    labels = self.templates
+    if level:
+      scale, labels = level
+      if scale < 1:
+        cell = Resize(cell, scale)
+    for label, templates in labels.iteritems():
+      start = time.time()
+      scores[label] = max(
+          cv2.minMaxLoc(cv2.matchTemplate(cell, t, cv2.TM_CCOEFF_NORMED))[1]
+          for t in templates)
+      timings[label] = time.time() - start
+    return scores, timings
+
+  def Match(self, cells):
+    """Returns the label scores of every cell in cells"""
+    if not cells:
+      return []
+
+    start = time.time()
+    if self.pyramid:
+      levels = [self.pyramid.Level(cell.shape) for cell in cells]
+    else:
+      levels = [None] * len(cells)
+    results = self.pool.map(lambda args: self.Scores(*args), zip(cells, levels))
+    elapsed = time.time() - start
+
+    self.cells += len(cells)
+    self.elapsed += elapsed
+    for _, timings in results:
+      for label, t in timings.iteritems():
+        self.timings[label] += t
+    matching = sum(sum(timings.values()) for _, timings in results)
+    logging.debug("Matched {0} cells in {1:.1f}ms ({2:.1f}ms matching)".format(
+        len(cells), elapsed * 1000, matching * 1000))
+    return [scores for scores, _ in results]
+
+  def Timings(self):
+    """Returns a summary of the time spent per label"""
+    total = sum(self.timings.values()) or 1
+    return ", ".join("{0}: {1:.1f}ms ({2:.0%})".format(
+        getattr(label, "name", label), t * 1000, t / total)
+                     for label, t in sorted(self.timings.iteritems(),
+                                            key=lambda item: -item[1]))
+
+  def Close(self):
+    self.pool.terminate()
+    if self.cells:
+      logging.info("Matched {0} cells in {1:.1f}ms. {2}".format(
+          self.cells, self.elapsed * 1000, self.Timings()))
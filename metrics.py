@@ -0,0 +1,196 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import bisect
+import logging
+import threading
+import collections
+import BaseHTTPServer
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0]
+
+PREFIX = "airport"
+
+
+class Histogram(object):
+
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def Observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def Percentile(self, p):
+    """Returns the upper bound of the bucket holding the p-th percentile"""
+    rank = self.count * p / 100.0
+    seen = 0
+    for bound, count in zip(self.buckets + [float("inf")], self.counts):
+      seen += count
+      if seen >= rank:
+        return bound
+    return float("inf")
+
+
+class Timer(object):
+
+  def __init__(self, metrics, stage):
+    self.metrics = metrics
+    self.stage = stage
+
+  def __enter__(self):
+    self.start = time.time()
+
+  def __exit__(self, *exc_info):
+    self.metrics.Observe(self.stage, time.time() - self.start)
+
+
+class Metrics(object):
+  """Latency histograms of the solver's stages, and event counters.
+
+  Time a stage with:
+    with metrics.Stage("recognize"):
+      ...
+  Frame should be called once per frame. It logs a summary every interval
+  seconds, unless interval is 0."""
+
+  def __init__(self, interval=0):
+    self.stages = collections.OrderedDict()
+    self.counters = collections.Counter()
+    self.interval = interval
+    self.start = self.last_log = time.time()
+    self.frames = self.last_frames = 0
+
+  def Stage(self, stage):
+    return Timer(self, stage)
+
+  def Observe(self, stage, seconds):
+    if stage not in self.stages:
+      self.stages[stage] = Histogram()
+    self.stages[stage].Observe(seconds)
+
+  def Count(self, event, n=1):
+    self.counters[event] += n
+
+  def Frame(self):
+    self.frames += 1
+    now = time.time()
+    if self.interval and now - self.last_log >= self.interval:
+      fps = (self.frames - self.last_frames) / (now - self.last_log)
+      logging.info(self.Summary(fps))
+      self.last_log = now
+      self.last_frames = self.frames
+
+  def FPS(self):
+    return self.frames / max(time.time() - self.start, 1e-6)
+
+  def Summary(self, fps=None):
+    lines = ["{0} frames, {1:.1f} fps".format(
+        self.frames, self.FPS() if fps is None else fps)]
+    for stage, h in self.stages.items():
+      lines.append("  {0}: {1} calls, mean {2:.1f}ms, p50 <{3:g}ms, "
+                   "p99 <{4:g}ms".format(stage, h.count, h.sum / h.count *
+                                         1000, h.Percentile(50) * 1000,
+                                         h.Percentile(99) * 1000))
+    lines += ["  {0}: {1}".format(k, v)
+              for k, v in sorted(self.counters.items())]
+    return "\n".join(lines)
+
+  def Prometheus(self):
+    """Returns the metrics in Prometheus' text exposition format"""
+    lines = ["# TYPE {0}_stage_seconds histogram".format(PREFIX)]
+    for stage, h in self.stages.items():
+      cumulative = 0
+      for bound, count in zip(h.buckets + ["+Inf"], h.counts):
+        cumulative += count
+        lines.append('{0}_stage_seconds_bucket{{stage="{1}",le="{2}"}} {3}'.
+                     format(PREFIX, stage, bound, cumulative))
+      lines.append('{0}_stage_seconds_sum{{stage="{1}"}} {2}'.format(
+          PREFIX, stage, h.sum))
+      lines.append('{0}_stage_seconds_count{{stage="{1}"}} {2}'.format(
+          PREFIX, stage, h.count))
+
+    lines.append("# TYPE {0}_events_total counter".format(PREFIX))
+    lines += ['{0}_events_total{{event="{1}"}} {2}'.format(PREFIX, k, v)
+              for k, v in sorted(self.counters.items())]
+    lines.append("# TYPE {0}_frames_total counter".format(PREFIX))
+    lines.append("{0}_frames_total {1}".format(PREFIX, self.frames))
+    lines.append("# TYPE {0}_fps gauge".format(PREFIX))
+    lines.append("{0}_fps {1}".format(PREFIX, self.FPS()))
+    return "\n".join(lines) + "\n"
+
+
+class NullTimer(object):
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc_info):
+    pass
+
+
+class NullMetrics(object):
+  """Metrics that record nothing, for when instrumentation is disabled"""
+  timer = NullTimer()
+
+  def Stage(self, stage):
+    return self.timer
+
+  def Observe(self, stage, seconds):
+    pass
+
+  def Count(self, event, n=1):
+    pass
+
+  def Frame(self):
+    pass
+
+
+class MetricsServer(object):
+  """Serves metrics.Prometheus() at http://localhost:port/metrics from a
+  background thread"""
+
+  def __init__(self, metrics, port):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        if self.path != "/metrics":
+          self.send_error(404)
+          return
+        body = metrics.Prometheus()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    self.server = BaseHTTPServer.HTTPServer(("localhost", port), Handler)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    logging.info("Serving metrics on http://localhost:{0}/metrics".format(
+        self.server.server_address[1]))
+
+  def Close(self):
+    self.server.shutdown()
+    self.server.server_close()
@@ -12,7 +12,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import collections
+import itertools
 import numpy as np
+import board
 from board import SquareType
 import color
 from enum import Enum
@@ -77,3 +80,64 @@ Colors = {PieceType.L_RED: color.Color("darkred"),
           PieceType.L_BLACK: color.Color("black"),
           PieceType.I_RED: color.Color("red"),
           PieceType.I_ORANGE: color.Color("yellow")}
+
+
+class Placement(collections.namedtuple(
+    "Placement", ["piece_type", "orientation", "i", "j", "bits", "mask"])):
+  """A piece in one of its orientations, with its top left square at (i, j).
+
+  bits is the bitboard of the placed piece and mask the squares it covers."""
+
+  @property
+  def location(self):
+    """The (piece_type, piece, i, j) tuple solutions are made of"""
+    return (self.piece_type, Orientations[self.piece_type][self.orientation],
+            self.i, self.j)
+
+
+def BuildPlacements(piece_type):
+  placements = []
+  for k, piece in enumerate(Orientations[piece_type]):
+    piece_bits = board.ToBits(piece)
+    for i, j in itertools.product(range(5), range(5)):
+      bits = tuple(m << (6 * i + j) for m in piece_bits)
+      placements.append(Placement(piece_type, k, i, j, bits,
+                                  board.Occupied(bits)))
+  return placements
+
+# All placements of all pieces, in the order FindAllSolutions tries them.
+AllPlacements = dict((p, BuildPlacements(p)) for p in PieceType)
+
+# Placements that leave the board's border empty. Others can't be part of a
+# solution.
+Placements = dict((p, [pl for pl in AllPlacements[p]
+                       if board.IsSolvedBits(pl.bits)]) for p in PieceType)
+
+_PlacementsByLocation = dict(((pl.piece_type, tuple(
+    pl.location[1].flat), pl.i, pl.j), pl) for p in PieceType
+                             for pl in AllPlacements[p])
+
+_PlacementsByIndex = dict(((pl.piece_type, pl.orientation, pl.i, pl.j), pl)
+                          for p in PieceType for pl in AllPlacements[p])
+
+
+def PlacementAt(piece_type, orientation, i, j):
+  return _PlacementsByIndex[(piece_type, orientation, i, j)]
+
+
+def FindPlacement(location):
+  """Returns the Placement of a (piece_type, piece, i, j) tuple"""
+  piece_type, piece, i, j = location
+  return _PlacementsByLocation[(piece_type, tuple(piece.flat), i, j)]
+
+
+def Rotate(placement, times=1):
+  """Returns the placement rotated with the board times * 90deg clock wise.
+
+  Orientations are ordered by clock wise rotation, so a rotated piece is
+  the next orientation of the same piece."""
+  for _ in range(times % 4):
+    placement = PlacementAt(placement.piece_type,
+                            (placement.orientation + 1) % 4, placement.j,
+                            4 - placement.i)
+  return placement
@@ -0,0 +1,314 @@
+#!/usr/local/bin/python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import json
+import time
+import Queue
+import logging
+import argparse
+import threading
+import traceback
+import collections
+import SocketServer
+import BaseHTTPServer
+import multiprocessing
+import numpy as np
+import board
+import solver
+import solutions
+import solution_db
+import matching
+import batch
+
+DEFAULT_PORT = 8470
+
+# Larger uploads are rejected
+MAX_UPLOAD_BYTES = 16 << 20
+
+# Connections the kernel queues for accept, beyond the requests that may
+# wait for the dispatcher. Connections past the backlog are reset instead of
+# being answered with a 503.
+BACKLOG_HEADROOM = 128
+
+
+class Busy(Exception):
+  pass
+
+
+class Request(object):
+
+  def __init__(self, name, data):
+    self.image = (name, data)
+    self.result = None
+    self.done = threading.Event()
+
+
+class SolveQueue(object):
+  """Batches image solving requests to a pool of batch.Worker processes.
+
+  A dispatcher thread takes up to batch_size requests, waiting at most
+  batch_window seconds for a batch to fill, and solves them in one round
+  trip to the pool. Up to max_pending requests may wait for the dispatcher.
+  Beyond that Solve raises Busy, so clients back off instead of piling up."""
+
+  def __init__(self, pool, batch_size=8, batch_window=0.005, max_pending=32):
+    self.pool = pool
+    self.batch_size = batch_size
+    self.batch_window = batch_window
+    self.requests = Queue.Queue(max_pending)
+    self.batches = 0
+    self.solved = 0
+    self.rejected = 0
+    self.thread = threading.Thread(target=self.Run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Solve(self, name, data):
+    """Returns the batch.Worker result of the encoded image data"""
+    request = Request(name, data)
+    try:
+      self.requests.put_nowait(request)
+    except Queue.Full:
+      self.rejected += 1
+      raise Busy()
+    request.done.wait()
+    return request.result
+
+  def NextBatch(self):
+    requests = [self.requests.get()]
+    deadline = time.time() + self.batch_window
+    while len(requests) < self.batch_size:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      try:
+        requests.append(self.requests.get(timeout=remaining))
+      except Queue.Empty:
+        break
+    return requests
+
+  def Run(self):
+    while True:
+      requests = self.NextBatch()
+      try:
+        results = self.pool.map(batch.SolveData, [r.image for r in requests],
+                                chunksize=1)
+      except Exception, e:
+        logging.error(traceback.format_exc())
+        results = [{"image": r.image[0], "error": str(e)} for r in requests]
+      self.batches += 1
+      self.solved += len(requests)
+      for request, result in zip(requests, results):
+        request.result = result
+        request.done.set()
+
+  def Stats(self):
+    return collections.OrderedDict([("pending", self.requests.qsize()),
+                                    ("batches", self.batches),
+                                    ("solved", self.solved),
+                                    ("rejected", self.rejected)])
+
+
+def ParseBoard(rows, values):
+  """Returns a 4x4 array of the values named in rows, None for null"""
+  cells = np.array([None] * 16, dtype='O').reshape(4, 4)
+  if len(rows) != 4 or any(len(row) != 4 for row in rows):
+    raise ValueError("Expected 4 rows of 4 squares")
+  for i, row in enumerate(rows):
+    for j, name in enumerate(row):
+      if name is not None:
+        cells[i, j] = values[name]
+  return cells
+
+
+def LookupBoard(db, request):
+  """Returns the solutions of a detected board given as JSON.
+
+  request has a "puzzle" of 4 rows of 4 SquareType names, and optionally
+  "constraints" of 4 rows of 4 Constraint names or nulls."""
+  objects = ParseBoard(request["puzzle"], board.SquareType.__members__)
+  objects[objects == board.SquareType.AIR] = None
+  constraints = ParseBoard(request.get("constraints", [[None] * 4] * 4),
+                           solver.Constraint.__members__)
+  puzzle = solver.BuildPuzzleBoardFromObjects(objects)
+  matches = solutions.Lookup(db, puzzle, *solver.ConstraintMasks(constraints))
+  return collections.OrderedDict([
+      ("solutions", [[batch.Location(l) for l in m] for m in matches])
+  ])
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, port, db, queue, backlog=5):
+    # Read by server_activate, in HTTPServer's constructor
+    self.request_queue_size = backlog
+    BaseHTTPServer.HTTPServer.__init__(self, ("localhost", port), Handler)
+    self.db = db
+    self.queue = queue
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves:
+    POST /solve   An encoded image. Returns batch.Worker's JSON result.
+    POST /lookup  A JSON detected board. Returns its solutions.
+    GET /health   Queue statistics."""
+
+  def Reply(self, code, body, headers=()):
+    body = json.dumps(body) + "\n"
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    for header in headers:
+      self.send_header(*header)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def ReadBody(self):
+    length = self.headers.getheader("Content-Length") or "0"
+    if not length.isdigit():
+      self.Reply(400, {"error": "Bad Content-Length"})
+      return None
+    length = int(length)
+    if length > MAX_UPLOAD_BYTES:
+      self.Reply(413, {"error": "Upload too large"})
+      return None
+    return self.rfile.read(length)
+
+  def do_GET(self):
+    if self.path == "/health":
+      self.Reply(200, self.server.queue.Stats())
+    else:
+      self.Reply(404, {"error": "Not found"})
+
+  def do_POST(self):
+    if self.path not in ("/solve", "/lookup"):
+      self.Reply(404, {"error": "Not found"})
+      return
+    data = self.ReadBody()
+    if data is None:
+      return
+
+    if self.path == "/lookup":
+      try:
+        result = LookupBoard(self.server.db, json.loads(data))
+      except (ValueError, KeyError, TypeError), e:
+        self.Reply(400, {"error": "Bad board: {0}".format(e)})
+        return
+      self.Reply(200, result)
+      return
+
+    if not data:
+      self.Reply(400, {"error": "No image"})
+      return
+    try:
+      result = self.server.queue.Solve(self.headers.getheader("X-Image-Name",
+                                                              "upload"), data)
+    except Busy:
+      self.Reply(503, {"error": "Too many pending requests"},
+                 [("Retry-After", "1")])
+      return
+    self.Reply(200, result)
+
+  def log_message(self, format, *args):
+    logging.debug(format % args)
+
+
+def main():
+  try:
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port",
+                        type=int,
+                        default=DEFAULT_PORT,
+                        help="Port to listen on, on localhost")
+    parser.add_argument("--db",
+                        type=str,
+                        default=solution_db.DB_FILENAME,
+                        help="Solutions database file")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of processes to solve images with")
+    parser.add_argument("--batch_size",
+                        type=int,
+                        default=8,
+                        help="Most images to send the workers at once")
+    parser.add_argument("--batch_window",
+                        type=float,
+                        default=5,
+                        help="Milliseconds to wait for a batch to fill")
+    parser.add_argument("--max_pending",
+                        type=int,
+                        default=32,
+                        help="Images that may wait for a worker before "
+                        "requests are rejected")
+    parser.add_argument("--cell_size",
+                        type=int,
+                        default=matching.CELL_SIZE,
+                        help="Size to downscale larger cells to before "
+                        "matching. 0 matches cells as they are")
+    parser.add_argument("--max_mismatches",
+                        type=int,
+                        default=0,
+                        help="Squares a solution may differ from the detected "
+                        "board in, when there is no exact solution")
+    parser.add_argument("--coarse_width",
+                        type=int,
+                        default=solver.COARSE_WIDTH,
+                        help="Width to downscale images to when locating the "
+                        "card. 0 preprocesses the whole image")
+    parser.add_argument("--config",
+                        type=str,
+                        help="JSON file of detection parameters, as written "
+                        "by tune.py")
+    parser.add_argument("-v",
+                        "--verbose",
+                        action="store_true",
+                        help="Enable debug prints")
+
+    args = parser.parse_args()
+    if args.verbose:
+      logging.getLogger('').handlers = []
+      logging.basicConfig(level=logging.DEBUG)
+
+    params = solver.DEFAULT_PARAMS
+    if args.config:
+      params = solver.LoadParams(args.config)
+    pool = multiprocessing.Pool(args.jobs, batch.InitWorker,
+                                (args.db, args.cell_size, args.max_mismatches,
+                                 args.coarse_width, params))
+    try:
+      queue = SolveQueue(pool, args.batch_size, args.batch_window / 1000.0,
+                         args.max_pending)
+      server = Server(args.port, solution_db.SolutionDB(args.db), queue,
+                      args.max_pending + BACKLOG_HEADROOM)
+      logging.info("Serving on http://localhost:{0}".format(
+          server.server_address[1]))
+      server.serve_forever()
+    finally:
+      pool.terminate()
+
+  except KeyboardInterrupt:
+    logging.info("Stopped")
+  except Exception, e:
+    logging.error(traceback.format_exc())
+    return e
+
+
+if __name__ == "__main__":
+  sys.exit(main())
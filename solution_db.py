@@ -0,0 +1,325 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Memory mapped solutions database.
+
+File layout, all little endian:
+  header   MAGIC, VERSION, pieces per record, #records, #keys, #postings
+  keys     int64[#keys], sorted
+  offsets  uint32[#keys + 1], postings of keys[k] are postings[offsets[k]:
+           offsets[k + 1]]
+  postings uint32[#postings], record number << 2 | rotation
+  features uint32[#postings], 2 bits per inner square of the posting's
+           solution: whether it holds a vertical / a horizontal plane
+  records  uint8[#records][pieces per record][2], every piece is stored as
+           (piece_type, orientation << 6 | i << 3 | j)
+
+Lookups binary search the keys and decode only the matching records, so
+opening the database doesn't deserialize anything.
+
+Rotating the board (and the pieces on it) by 90deg turns a solution into
+another solution, so only one solution of every such group is stored as a
+record. A posting refers to the record rotated clock wise rotation times.
+
+The database is built from a raw records file: RAW_MAGIC, RAW_VERSION and then
+records in the same format, in the order they were appended.
+"""
+import os
+import json
+import mmap
+import shutil
+import itertools
+import multiprocessing
+import struct
+import logging
+import numpy as np
+import pieces
+
+DB_FILENAME = "solutions.db"
+MAGIC = "AIRPRTDB"
+VERSION = 4
+
+RAW_MAGIC = "AIRPRTRW"
+RAW_VERSION = 1
+
+# Records per task when computing keys in parallel
+_CHUNK_SIZE = 1024
+
+_HEADER = struct.Struct("<8sIIIII")
+_RAW_HEADER = struct.Struct("<8sI")
+
+
+def EncodeRecord(locations):
+  """Packs a solution into a fixed width record"""
+  record = []
+  for location in locations:
+    placement = pieces.FindPlacement(location)
+    record += [placement.piece_type.value,
+               placement.orientation << 6 | placement.i << 3 | placement.j]
+  return struct.pack("{0}B".format(len(record)), *record)
+
+
+def DecodeRecord(record, rotation=0):
+  """Unpacks a record back to a list of (piece_type, piece, i, j).
+
+  The solution is rotated clock wise rotation times."""
+  locations = []
+  for k in range(0, len(record), 2):
+    packed = record[k + 1]
+    placement = pieces.PlacementAt(pieces.PieceType(record[k]), packed >> 6,
+                                   packed >> 3 & 7, packed & 7)
+    locations.append(pieces.Rotate(placement, rotation).location)
+  return locations
+
+
+def _RecordSize():
+  return 2 * len(pieces.PieceType)
+
+
+def _WriteTables(filename, keys, offsets, postings, features, records):
+  tmp_filename = filename + ".tmp"
+  with open(tmp_filename, "wb") as f:
+    f.write(_HEADER.pack(MAGIC, VERSION, records.shape[1] / 2, len(records),
+                         len(keys), len(postings)))
+    f.write(np.asarray(keys, dtype="<i8").tostring())
+    f.write(np.asarray(offsets, dtype="<u4").tostring())
+    f.write(np.asarray(postings, dtype="<u4").tostring())
+    f.write(np.asarray(features, dtype="<u4").tostring())
+    f.write(records.tostring())
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp_filename, filename)
+  logging.info("Wrote {0} solutions under {1} keys to {2}".format(len(
+      records), len(keys), filename))
+
+
+class RecordWriter(object):
+  """Appends solution records to a raw records file.
+
+  Records are written in batches to a temporary file, which replaces the
+  raw file on Commit. A run that dies before committing leaves the previous
+  file intact.
+
+  Checkpoint syncs the records written so far along with a caller's state.
+  A run that dies after a checkpoint keeps its temporary file, and a writer
+  created with resume=True continues from the last checkpoint. Its state is
+  then in resumed_state. Any other writer discards the checkpoint."""
+
+  def __init__(self, filename, append=False, batch_size=4096, resume=False):
+    self.filename = filename
+    self.tmp_filename = filename + ".tmp"
+    self.checkpoint_filename = filename + ".checkpoint"
+    self.batch_size = batch_size
+    self.batch = []
+    self.count = 0
+    self.checkpointed = False
+    self.resumed_state = None
+    if not resume and os.path.exists(self.checkpoint_filename):
+      logging.info("Discarding the checkpoint {0}".format(
+          self.checkpoint_filename))
+      os.remove(self.checkpoint_filename)
+
+    if resume and os.path.exists(self.checkpoint_filename):
+      with open(self.checkpoint_filename) as f:
+        checkpoint = json.load(f)
+      self.count = checkpoint["records"]
+      self.resumed_state = checkpoint["state"]
+      self.checkpointed = True
+      # Drop the records written after the checkpoint
+      size = _RAW_HEADER.size + self.count * _RecordSize()
+      self.f = open(self.tmp_filename, "r+b")
+      header = self.f.read(_RAW_HEADER.size)
+      if (len(header) < _RAW_HEADER.size or
+          _RAW_HEADER.unpack(header) != (RAW_MAGIC, RAW_VERSION) or
+          os.fstat(self.f.fileno()).st_size < size):
+        self.f.close()
+        raise ValueError("{0} doesn't hold the {1} records of {2}".format(
+            self.tmp_filename, self.count, self.checkpoint_filename))
+      self.f.truncate(size)
+      self.f.seek(0, os.SEEK_END)
+      logging.info("Resuming from {0} records in {1}".format(
+          self.count, self.tmp_filename))
+    elif append and os.path.exists(filename):
+      self.count = len(ReadRecords(filename))
+      shutil.copyfile(filename, self.tmp_filename)
+      self.f = open(self.tmp_filename, "ab")
+    else:
+      self.f = open(self.tmp_filename, "wb")
+      self.f.write(_RAW_HEADER.pack(RAW_MAGIC, RAW_VERSION))
+
+  def Append(self, locations):
+    self.batch.append(EncodeRecord(locations))
+    self.count += 1
+    if len(self.batch) >= self.batch_size:
+      self.Flush()
+
+  def Flush(self):
+    self.f.write("".join(self.batch))
+    self.batch = []
+
+  def Sync(self):
+    self.Flush()
+    self.f.flush()
+    os.fsync(self.f.fileno())
+
+  def Checkpoint(self, state):
+    """Makes the records so far durable, along with the JSON state"""
+    self.Sync()
+    tmp_filename = self.checkpoint_filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+      json.dump({"records": self.count, "state": state}, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp_filename, self.checkpoint_filename)
+    self.checkpointed = True
+
+  def Commit(self):
+    self.Sync()
+    self.f.close()
+    os.rename(self.tmp_filename, self.filename)
+    if self.checkpointed:
+      os.remove(self.checkpoint_filename)
+    logging.info("Committed {0} records to {1}".format(self.count,
+                                                      self.filename))
+
+  def Abort(self):
+    self.f.close()
+    if self.checkpointed:
+      logging.info("Keeping {0} to resume from its checkpoint".format(
+          self.tmp_filename))
+    else:
+      os.remove(self.tmp_filename)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if exc_type is None:
+      self.Commit()
+    else:
+      self.Abort()
+
+
+def ReadRecords(filename):
+  """Returns the records of a raw records file as a memory mapped array"""
+  with open(filename, "rb") as f:
+    magic, version = _RAW_HEADER.unpack(f.read(_RAW_HEADER.size))
+  if magic != RAW_MAGIC or version != RAW_VERSION:
+    raise ValueError("{0} is not a raw records file of version {1}".format(
+        filename, RAW_VERSION))
+  records = np.memmap(filename, "u1", "r", _RAW_HEADER.size)
+  return records.reshape(-1, _RecordSize())
+
+
+def _ChunkKeys(args):
+  keys, records = args
+  return [keys(DecodeRecord(record)) for record in records.tolist()]
+
+
+def Finalize(raw_filename, db_filename, keys, jobs=1):
+  """Builds database file from a raw records file.
+
+  keys(locations) returns the (key, rotation, features) a solution is stored
+  under. Records without keys and duplicate records are dropped. Records
+  are streamed from the raw file, only their keys are held in memory. With
+  jobs > 1 keys are computed by a process pool."""
+  records = ReadRecords(raw_filename)
+  # Keep the first of every group of identical records
+  _, first = np.unique(
+      np.ascontiguousarray(records).view("V{0}".format(records.shape[1])),
+      return_index=True)
+  if len(first) != len(records):
+    logging.info("Dropping {0} duplicate records".format(len(records) - len(
+        first)))
+    records = records[np.sort(first)]
+
+  chunks = ((keys, records[k:k + _CHUNK_SIZE])
+            for k in xrange(0, len(records), _CHUNK_SIZE))
+  pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+  try:
+    chunk_keys = pool.imap(_ChunkKeys, chunks) if pool else itertools.imap(
+        _ChunkKeys, chunks)
+    kept = []
+    record_keys = []
+    postings = []
+    features = []
+    for n, solution_keys in enumerate(itertools.chain.from_iterable(
+        chunk_keys)):
+      if not solution_keys:
+        continue
+      for key, rotation, solution_features in solution_keys:
+        record_keys.append(key)
+        postings.append(len(kept) << 2 | rotation)
+        features.append(solution_features)
+      kept.append(n)
+  finally:
+    if pool:
+      pool.terminate()
+
+  record_keys = np.array(record_keys, dtype=np.int64)
+  postings = np.array(postings, dtype=np.uint32)
+  features = np.array(features, dtype=np.uint32)
+  order = np.lexsort((postings, record_keys))
+  unique_keys, starts = np.unique(record_keys[order], return_index=True)
+  _WriteTables(db_filename, unique_keys, np.append(starts, len(order)),
+               postings[order], features[order], records[kept])
+
+
+class SolutionDB(object):
+
+  def __init__(self, filename=DB_FILENAME):
+    with open(filename, "rb") as f:
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (magic, version, self.record_pieces, self.num_records, num_keys,
+     num_postings) = _HEADER.unpack_from(self.mm)
+    if magic != MAGIC:
+      raise ValueError("{0} is not a solutions database".format(filename))
+    if version != VERSION:
+      raise ValueError("{0} has version {1}, expected {2}. Rebuild it with "
+                       "solutions.py".format(filename, version, VERSION))
+
+    offset = _HEADER.size
+    self.keys = np.frombuffer(self.mm, "<i8", num_keys, offset)
+    offset += self.keys.nbytes
+    self.offsets = np.frombuffer(self.mm, "<u4", num_keys + 1, offset)
+    offset += self.offsets.nbytes
+    self.postings = np.frombuffer(self.mm, "<u4", num_postings, offset)
+    offset += self.postings.nbytes
+    self.features = np.frombuffer(self.mm, "<u4", num_postings, offset)
+    offset += self.features.nbytes
+    self.records = np.frombuffer(self.mm, "u1", self.num_records *
+                                 self.record_pieces * 2, offset).reshape(
+                                     self.num_records, -1)
+
+  def __len__(self):
+    return self.num_records
+
+  def Record(self, n, rotation=0):
+    return DecodeRecord(self.records[n].tolist(), rotation)
+
+  def Lookup(self, key, rotation=0, forbidden=0):
+    """Returns all solutions stored under key.
+
+    The key is of the board rotated clock wise rotation times, solutions are
+    rotated back to match the original board. Postings with any of the
+    forbidden feature bits are skipped."""
+    k = np.searchsorted(self.keys, key)
+    if k == len(self.keys) or self.keys[k] != key:
+      return []
+    postings = self.postings[self.offsets[k]:self.offsets[k + 1]]
+    if forbidden:
+      features = self.features[self.offsets[k]:self.offsets[k + 1]]
+      postings = postings[features & forbidden == 0]
+    return [self.Record(p >> 2, (p & 3) - rotation) for p in postings.tolist()]
@@ -14,112 +14,372 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import sys
-import os
 import time
 import random
 import numpy as np
 import logging
 import argparse
 import traceback
-import collections
-import threading
 import cPickle as pickle
-import copy
 import itertools
+import operator
+import multiprocessing
 import board
 import pieces
-
-DB_FILENAME = "solutions.pickle"
-
-
-def Store(key, value):
-  logging.debug("Saving {}".format(key))
-  save = {}
-  global DB_FILENAME
-  if os.path.exists(DB_FILENAME):
-    with open(DB_FILENAME, "rb") as f:
-      save = pickle.load(f)
-
-  with open(DB_FILENAME, "wb") as f:
-    save[key] = value
-    pickle.dump(save, f, pickle.HIGHEST_PROTOCOL)
-
-
-def Load(key):
-  global DB_FILENAME
-  with open(DB_FILENAME, "rb") as f:
-    save = pickle.load(f)
-    return save[key]
-
-
-class AsyncLoader(threading.Thread):
-
-  def run(self):
-    global DB_FILENAME
-    with open(DB_FILENAME, "rb") as f:
-      self.db = pickle.load(f)
-    logging.info("Done loading solutions")
-
-
-def FindAllSolutions():
+import exact_cover
+import solution_db
+
+RAW_FILENAME = "solutions.raw"
+
+# Number of pieces placed before the search is split into subtrees, which are
+# searched in parallel and checkpointed
+SPLIT_DEPTH = 2
+
+# Seconds between checkpoints when storing all solutions
+CHECKPOINT_INTERVAL = 10
+
+
+def Search(occupied, left, solution, found, placements=pieces.Placements):
+  """Calls found with every way to complete solution with the left pieces.
+
+  occupied is the mask of squares solution covers. Pieces are placed from the
+  end of left, trying the placements of each piece type in placements."""
+  if not left:
+    found(solution)
+    return
+
+  # Placements are precompiled to bitmasks and never touch the border, so a
+  # placement is valid as long as it doesn't overlap the occupied squares.
+  for placement in placements[left[-1]]:
+    if not occupied & placement.mask:
+      Search(occupied | placement.mask, left[:-1], solution + [placement],
+             found, placements)
+
+
+def SplitSearch(depth):
+  """Returns the placements of the first depth pieces of all search branches"""
+  prefixes = []
+  Search(0, list(pieces.PieceType)[-depth:], [], prefixes.append)
+  return prefixes
+
+
+def SearchSubtree(prefix):
+  """Returns all solutions starting with prefix as lists of placements"""
+  left = list(pieces.PieceType)[:-len(prefix)]
+  subtree = []
+  Search(reduce(operator.or_, [p.mask for p in prefix]), left, prefix,
+         subtree.append)
+  return subtree
+
+
+def ExactCoverSolutions():
+  """Returns all solutions as lists of placements, in Search's order.
+
+  The puzzle is solved as an exact cover problem: there is a column for
+  every inner square and for every piece. Each placement is a row covering
+  the squares of the piece and the piece's column."""
+  piece_types = list(pieces.PieceType)
+  squares = [board.Bit(i, j) for i, j in board.INNER_SQUARES]
+  placements = [p for piece_type in piece_types
+                for p in pieces.Placements[piece_type]]
+  rows = [[n for n, bit in enumerate(squares) if p.mask & bit] +
+          [len(squares) + piece_types.index(p.piece_type)] for p in placements]
+
+  # Rows of every piece are in Search's order, and Search places the pieces
+  # from last to first.
+  order = [(-piece_types.index(p.piece_type), r)
+           for r, p in enumerate(placements)]
+  links = exact_cover.DancingLinks(len(squares) + len(piece_types), rows)
+  solutions = [sorted(solution, key=order.__getitem__)
+               for solution in links.Solutions()]
+  return [[placements[r] for r in solution] for solution in sorted(solutions)]
+
+
+def EnumerateSolutions(start=0, jobs=1):
+  """Yields (n, solutions) for every search subtree n from start on.
+
+  The search tree is split by the placements of the first SPLIT_DEPTH
+  pieces. The solutions of each subtree are lists of locations, in the order
+  Search finds them. Only a few subtrees are held in memory at a time, so
+  a run can stream them to a store and resume from any subtree. With
+  jobs > 1 subtrees are searched by a process pool."""
+  prefixes = SplitSearch(SPLIT_DEPTH)[start:]
+  pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+  try:
+    subtrees = pool.imap(SearchSubtree, prefixes) if pool else itertools.imap(
+        SearchSubtree, prefixes)
+    for n, subtree in enumerate(subtrees, start):
+      yield n, [[p.location for p in solution] for solution in subtree]
+  finally:
+    if pool:
+      pool.terminate()
+
+
+def FindAllSolutions(found=None, jobs=1, engine="search"):
+  """Returns all solutions.
+
+  If found is given it is called with every solution instead. engine is
+  either "search", which tries all placements piece by piece, or "dlx",
+  which solves the puzzle as exact cover with dancing links. With jobs > 1
+  the search tree is split by the placements of the first pieces across a
+  process pool. Solutions are found in the same order either way."""
   all_solutions = []
+  found = found or all_solutions.append
+  count = 0
+
+  if engine == "dlx":
+    for solution in ExactCoverSolutions():
+      found([p.location for p in solution])
+      count += 1
+  else:
+    for _, subtree in EnumerateSolutions(0, jobs):
+      for locations in subtree:
+        found(locations)
+      count += len(subtree)
+
+  logging.info("found {} solutions".format(count))
+  return all_solutions
 
-  def Search(current, left, solution):
-    if not board.IsSolved(current):
-      return
-
-    if not left:
-      all_solutions.append(solution)
-      return
-
-    piece_type = left.pop()
-    for piece, i, j in itertools.product(pieces.Orientations[piece_type],
-                                         range(5), range(5)):
-      try:
-        new = copy.copy(current)
-        new[i:i + 2, j:j + 2] += piece
-        Search(new, copy.copy(left),
-               copy.copy(solution) + [(piece_type, piece, i, j)])
-      except ValueError:
-        pass
-
-  Search(board.Empty(), list(pieces.PieceType), [])
 
-  logging.info("found {} solutions".format(len(all_solutions)))
-  return all_solutions
+def StoreAllSolutions(writer, jobs=1, interval=CHECKPOINT_INTERVAL):
+  """Appends all solutions to a solution_db.RecordWriter, checkpointing
+  every interval seconds.
+
+  If the writer resumed from a checkpoint, enumeration continues from the
+  first subtree the checkpoint doesn't cover."""
+  start = 0
+  state = writer.resumed_state
+  if state:
+    if state["split_depth"] != SPLIT_DEPTH:
+      raise ValueError("Checkpoint was made with split depth {0}, not {1}".
+                       format(state["split_depth"], SPLIT_DEPTH))
+    start = state["subtree"]
+    logging.info("Resuming from subtree {0}".format(start))
+
+  last = time.time()
+  for n, subtree in EnumerateSolutions(start, jobs):
+    for locations in subtree:
+      writer.Append(locations)
+    if time.time() - last >= interval:
+      writer.Checkpoint({"split_depth": SPLIT_DEPTH, "subtree": n + 1})
+      logging.debug("Checkpointed {0} records after subtree {1}".format(
+          writer.count, n))
+      last = time.time()
+  logging.info("{0} solutions stored".format(writer.count))
 
 
 def PlacePieces(locations):
-  b = board.Empty()
-  for piece_type, piece, i, j in locations:
-    b[i:i + 2, j:j + 2] += piece
-  # Remove glass
-  b[np.where(b == board.SquareType.GLASS)] = board.SquareType.AIR
-  return b
+  """Returns the bitboard of the given solution, without glass"""
+  bits = [0] * len(board.SquareType)
+  for location in locations:
+    for k, mask in enumerate(pieces.FindPlacement(location).bits):
+      bits[k] |= mask
+  return board.RemoveGlass(tuple(bits))
 
 
 def HashByExactOrientation(b):
   # No need to change the squares in board
-  return hash(str(b))
+  return board.Key(b)
 
 
 def HashByAnyOrientation(b):
-  b[np.where(b == board.SquareType.UP)] = board.SquareType.ANY
-  b[np.where(b == board.SquareType.RIGHT)] = board.SquareType.ANY
-  b[np.where(b == board.SquareType.DOWN)] = board.SquareType.ANY
-  b[np.where(b == board.SquareType.LEFT)] = board.SquareType.ANY
-  return hash(str(b))
-
+  return board.Key(board.AnyOrientation(b))
+
+
+def PackSquares(vertical, horizontal):
+  """Packs two masks to 2 bits per inner square, vertical in the lower bit"""
+  packed = 0
+  for n, (i, j) in enumerate(board.INNER_SQUARES):
+    bit = board.Bit(i, j)
+    if vertical & bit:
+      packed |= 1 << 2 * n
+    if horizontal & bit:
+      packed |= 2 << 2 * n
+  return packed
+
+
+def Features(b):
+  """Packs which squares of a solution hold vertical or horizontal planes"""
+  square = lambda square_type: b[square_type.value]
+  return PackSquares(
+      square(board.SquareType.UP) | square(board.SquareType.DOWN),
+      square(board.SquareType.LEFT) | square(board.SquareType.RIGHT))
+
+
+def RotateSolution(locations, times=1):
+  """Rotates the solution with the board times * 90deg clock wise"""
+  return [pieces.Rotate(pieces.FindPlacement(location), times).location
+          for location in locations]
+
+
+def IsCanonical(locations):
+  """Whether this solution is the one stored for all its rotations"""
+  rotations = [[(p.orientation, p.i, p.j)
+                for p in map(pieces.FindPlacement, RotateSolution(
+                    locations, times))] for times in range(4)]
+  return rotations[0] == min(rotations)
+
+
+def CanonicalKey(b, key):
+  """Returns the smallest key of b's rotations, and the rotation giving it"""
+  keys = [key(board.Rotate(b, times)) for times in range(4)]
+  rotation = keys.index(min(keys))
+  return keys[rotation], rotation
+
+
+def SolutionKeys(locations):
+  """Returns the (key, rotation, features) a solution is stored under.
+
+  Only canonical solutions are stored. Each rotation of the solution is
+  stored under the keys of its board that are canonical keys."""
+  if not IsCanonical(locations):
+    return []
+
+  b = PlacePieces(locations)
+  keys = []
+  for key in (HashByExactOrientation, HashByAnyOrientation):
+    rotated = [key(board.Rotate(b, rotation)) for rotation in range(4)]
+    keys += [(k, rotation, Features(board.Rotate(b, rotation)))
+             for rotation, k in enumerate(rotated) if k == min(rotated)]
+  return keys
+
+
+def Lookup(db, puzzle, vertical=0, horizontal=0):
+  """Returns all solutions of the puzzle board.
+
+  vertical and horizontal are masks of squares with VERTICAL and HORIZONTAL
+  constraints. Solutions with a horizontal plane on a VERTICAL square or a
+  vertical plane on a HORIZONTAL square are filtered out."""
+  key, rotation = CanonicalKey(puzzle, HashByExactOrientation)
+  vertical = board.RotateMask(vertical, rotation)
+  horizontal = board.RotateMask(horizontal, rotation)
+  if rotation % 2:
+    vertical, horizontal = horizontal, vertical
+  return db.Lookup(key, rotation, PackSquares(horizontal, vertical))
+
+
+def PuzzlePlacements(puzzle, vertical=0, horizontal=0, piece_types=None):
+  """Returns the placements of every piece type that agree with puzzle.
+
+  A placement agrees with the puzzle if its plane is on a square of the
+  puzzle with the same plane or with ANY, which no constraint forbids, and
+  its other squares don't cover any of the puzzle's planes. vertical and
+  horizontal are masks of constraints, as in Lookup."""
+  piece_types = piece_types or list(pieces.PieceType)
+  square = lambda square_type: puzzle[square_type.value]
+  planes = board.Occupied(puzzle)
+  allowed = {}
+  for square_type in board.ARROWS:
+    forbidden = vertical if square_type in (
+        board.SquareType.LEFT, board.SquareType.RIGHT) else horizontal
+    allowed[square_type] = (square(square_type) | square(board.SquareType.ANY)
+                           ) & ~forbidden
+
+  placements = {}
+  for piece_type in piece_types:
+    placements[piece_type] = []
+    for placement in pieces.Placements[piece_type]:
+      arrows = 0
+      for square_type in board.ARROWS:
+        bits = placement.bits[square_type.value]
+        if bits & ~allowed[square_type]:
+          break
+        arrows |= bits
+      else:
+        if not placement.mask & ~arrows & planes:
+          placements[piece_type].append(placement)
+  return placements
+
+
+def SolvePuzzle(puzzle, vertical=0, horizontal=0, piece_types=None):
+  """Returns all solutions of the puzzle board, searched for directly.
+
+  Unlike Lookup this needs no DB: only placements that agree with the
+  puzzle and its constraints are searched. A solution has a plane on every
+  plane of the puzzle. Squares with ANY match any plane, so puzzles may mix
+  planes and ANY squares. piece_types defaults to all pieces."""
+  piece_types = piece_types or list(pieces.PieceType)
+  planes = board.Occupied(puzzle)
+  if bin(planes).count("1") != len(piece_types):
+    return []
+
+  found = []
+  Search(0, piece_types, [], found.append,
+         PuzzlePlacements(puzzle, vertical, horizontal, piece_types))
+  logging.debug("Found {0} solutions".format(len(found)))
+  return [[p.location for p in solution] for solution in found]
+
+
+class PartialIndex(object):
+  """Index of the inner squares of all solutions, for inexact lookups.
+
+  Solution n is record n / 4 of the DB rotated n % 4 times. squares[s, t]
+  marks the solutions that have SquareType value t at inner square s."""
+
+  def __init__(self, db):
+    self.db = db
+    states = np.zeros((len(db), 4, len(board.INNER_SQUARES)), dtype=np.uint8)
+    for n in xrange(len(db)):
+      b = PlacePieces(db.Record(n))
+      for rotation in range(4):
+        states[n, rotation] = board.InnerSquares(board.Rotate(b, rotation))
+    states = states.reshape(-1, len(board.INNER_SQUARES))
+    self.squares = np.array([[states[:, s] == t for t in range(len(
+        board.SquareType))] for s in range(len(board.INNER_SQUARES))])
+    logging.info("Indexed {0} solutions".format(len(states)))
+
+  def Lookup(self, puzzle, scores, max_mismatches, vertical=0, horizontal=0):
+    """Returns solutions that differ from puzzle in up to max_mismatches
+    squares, best first.
+
+    scores holds the template match score of every inner square. A mismatch
+    on a square with a plane costs its score, a mismatch on an empty square
+    costs 1 - its score. Solutions are ordered by total cost. vertical and
+    horizontal are masks of constraints, as in Lookup."""
+    air, any_type = board.SquareType.AIR.value, board.SquareType.ANY.value
+    left, right = board.SquareType.LEFT.value, board.SquareType.RIGHT.value
+    up, down = board.SquareType.UP.value, board.SquareType.DOWN.value
+    mismatches = np.zeros(self.squares.shape[2], dtype=np.int32)
+    cost = np.zeros(self.squares.shape[2])
+    valid = np.ones(self.squares.shape[2], dtype=bool)
+    for s, value in enumerate(board.InnerSquares(puzzle)):
+      i, j = board.INNER_SQUARES[s]
+      if value == any_type:
+        mismatch = self.squares[s, air]
+      else:
+        mismatch = ~self.squares[s, value]
+      mismatches += mismatch
+      score = scores[i - 1, j - 1]
+      cost += mismatch * (1 - score if value == air else score)
+
+      if vertical & board.Bit(i, j):
+        valid &= ~(self.squares[s, left] | self.squares[s, right])
+      if horizontal & board.Bit(i, j):
+        valid &= ~(self.squares[s, up] | self.squares[s, down])
+
+    found = np.flatnonzero(valid & (mismatches <= max_mismatches))
+    found = found[np.argsort(cost[found], kind="mergesort")]
+    logging.debug("Found {0} solutions within {1} mismatches".format(len(
+        found), max_mismatches))
+    return [self.db.Record(n >> 2, n & 3) for n in found.tolist()]
+
+
+def ImportPickle(filename, found):
+  """Calls found with every solution in a pickled solutions DB"""
+  with open(filename, "rb") as f:
+    save = pickle.load(f)
+  if "raw_solutions" in save:
+    solutions = save["raw_solutions"]
+  else:
+    # Finalize drops the duplicates
+    solutions = itertools.chain.from_iterable(
+        save["board_to_solution"].itervalues())
+  for locations in solutions:
+    found(locations)
 
-def BuildHashableSolutions():
-  raw_solutions = Load("raw_solutions")
-  solutions = collections.defaultdict(list)
-  for locations in raw_solutions:
-    b = PlacePieces(locations)
-    solutions[HashByExactOrientation(b)].append(locations)
-    solutions[HashByAnyOrientation(b)].append(locations)
 
-  Store("board_to_solution", solutions)
+def BuildHashableSolutions(raw_filename, db_filename, jobs=1):
+  solution_db.Finalize(raw_filename, db_filename, SolutionKeys, jobs)
 
 
 def main():
@@ -127,6 +387,39 @@ def main():
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser()
+    parser.add_argument("--enumerate",
+                        action="store_true",
+                        help="Find all solutions before building the DB")
+    parser.add_argument("--engine",
+                        choices=["search", "dlx"],
+                        default="search",
+                        help="Algorithm to find all solutions with")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="Number of processes to search with")
+    parser.add_argument("--append",
+                        action="store_true",
+                        help="Add found solutions to the existing raw file")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="Continue an interrupted --enumerate from its "
+                        "last checkpoint")
+    parser.add_argument("--checkpoint_interval",
+                        type=float,
+                        default=CHECKPOINT_INTERVAL,
+                        help="Seconds between enumeration checkpoints")
+    parser.add_argument("--pickle",
+                        type=str,
+                        help="Import solutions from a pickled DB instead")
+    parser.add_argument("--raw",
+                        type=str,
+                        default=RAW_FILENAME,
+                        help="Raw solutions file")
+    parser.add_argument("--db",
+                        type=str,
+                        default=solution_db.DB_FILENAME,
+                        help="Solutions database file")
     parser.add_argument("-v",
                         "--verbose",
                         action="store_true",
@@ -137,10 +430,19 @@ def main():
       logging.getLogger('').handlers = []
       logging.basicConfig(level=logging.DEBUG)
 
-    #all_solutions = FindAllSolutions()
-    #Store("raw_solutions", all_solutions)
-
-    BuildHashableSolutions()
+    if args.pickle:
+      with solution_db.RecordWriter(args.raw, append=args.append) as writer:
+        ImportPickle(args.pickle, writer.Append)
+    elif args.enumerate and args.engine == "dlx":
+      with solution_db.RecordWriter(args.raw, append=args.append) as writer:
+        FindAllSolutions(writer.Append, args.jobs, args.engine)
+    elif args.enumerate:
+      with solution_db.RecordWriter(args.raw,
+                                    append=args.append,
+                                    resume=args.resume) as writer:
+        StoreAllSolutions(writer, args.jobs, args.checkpoint_interval)
+
+    BuildHashableSolutions(args.raw, args.db, args.jobs)
 
   except Exception, e:
     logging.error(traceback.format_exc())
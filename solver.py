@@ -26,18 +26,62 @@ import cPickle as pickle
 import operator
 import copy
 import glob
+import json
 import time
 from enum import Enum
 import image_source
 import board
 import pieces
 import solutions
+import solution_db
+import cell_cache
+import matching
+import metrics
 
 MAX_PLANES = 6
+# Template matches scoring less are ignored
+MIN_SCORE = 0.6
+# PrepareCard locates the card in the frame downscaled to this width
+COARSE_WIDTH = 160
+# Part of the frame's width around the card PrepareCard preprocesses as well,
+# to make up for the downscaled image's inaccuracy
+CARD_MARGIN = 0.025
+# Boards are at least this many pixels wide and high
+MIN_BOARD_SIZE = 100
 Options = None
 
 Rect = collections.namedtuple("Rect", ["x", "y", "w", "h"])
+# Parameters of the detection pipeline, which tune.py searches
+Params = collections.namedtuple("Params", [
+    "bilateral_diameter", "bilateral_sigma", "threshold_block", "threshold_c",
+    "hough_threshold", "hough_min_length", "hough_max_gap", "dilate_kernel",
+    "dilate_iterations", "min_score"
+])
+DEFAULT_PARAMS = Params(bilateral_diameter=9,
+                        bilateral_sigma=75,
+                        threshold_block=11,
+                        threshold_c=2,
+                        hough_threshold=100,
+                        hough_min_length=10,
+                        hough_max_gap=0,
+                        dilate_kernel=5,
+                        dilate_iterations=2,
+                        min_score=MIN_SCORE)
 Constraint = Enum("Constraint", "VERTICAL HORIZONTAL")
+OBJECTS = [board.SquareType.UP, board.SquareType.RIGHT, board.SquareType.DOWN,
+           board.SquareType.LEFT, board.SquareType.ANY]
+
+
+def LoadParams(filename):
+  """Returns the Params in a JSON file, such as the one tune.py writes.
+  Parameters missing from it keep their defaults."""
+  with open(filename) as f:
+    return DEFAULT_PARAMS._replace(**json.load(f))
+
+
+def SaveParams(params, filename):
+  with open(filename, "w") as f:
+    json.dump(params._asdict(), f, indent=2, separators=(",", ": "))
 
 
 def WaitKey(delay_ms=5):
@@ -49,7 +93,7 @@ def WaitKey(delay_ms=5):
 
 def DebugShow(image):
   global Options
-  if Options.verbose:
+  if Options and Options.verbose:
     stack = sys._getframe(1)
     cv2.imshow("{0}:{1}".format(stack.f_code.co_name, stack.f_lineno), image)
 
@@ -58,20 +102,78 @@ def Crop(img, rect):
   return img[rect.y:rect.y + rect.h, rect.x:rect.x + rect.w]
 
 
-def PrepareImage(image):
+def Contains(outer, inner):
+  return (outer.x <= inner.x and outer.y <= inner.y and
+          inner.x + inner.w <= outer.x + outer.w and
+          inner.y + inner.h <= outer.y + outer.h)
+
+
+def PrepareImage(image, params=DEFAULT_PARAMS):
   """Converts color image to black and white"""
   # work on gray scale
   bw = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
 
   # remove noise, preserve edges
-  bw = cv2.bilateralFilter(bw, 9, 75, 75)
+  bw = cv2.bilateralFilter(bw, params.bilateral_diameter,
+                           params.bilateral_sigma, params.bilateral_sigma)
 
   # binary threshold
   bw = cv2.adaptiveThreshold(bw, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                             cv2.THRESH_BINARY, 11, 2)
+                             cv2.THRESH_BINARY, params.threshold_block,
+                             params.threshold_c)
   return bw
 
 
+def FindCards(image, width=COARSE_WIDTH, count=1):
+  """Returns the locations of up to count cards in image, largest first.
+
+  The cards are the largest external contours of a downscaled copy that may
+  hold a board."""
+  scale = float(width) / image.shape[1]
+  if scale >= 1:
+    return [Rect(0, 0, image.shape[1], image.shape[0])]
+
+  small = cv2.resize(image, None, fx=scale, fy=scale,
+                     interpolation=cv2.INTER_AREA)
+  small = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_RGB2GRAY), (3, 3), 0)
+  small_bw = cv2.adaptiveThreshold(small, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                   cv2.THRESH_BINARY, 11, 2)
+  if count > 1:
+    cards = FindExternalContours(small_bw, count, int(MIN_BOARD_SIZE * scale))
+  else:
+    cards = [FindExternalContour(small_bw)]
+  return [Rect(int(card.x / scale), int(card.y / scale),
+               int(np.ceil(card.w / scale)), int(np.ceil(card.h / scale)))
+          for card in cards]
+
+
+def PrepareRegions(image, width=COARSE_WIDTH, margin=CARD_MARGIN,
+                   params=DEFAULT_PARAMS, count=1):
+  """Converts the cards' regions of a color image to black and white.
+
+  The card, or up to count cards, are located with FindCards, and only they
+  and a margin of margin times the frame's width around them go through
+  PrepareImage. Returns the black and white frame, black outside of those
+  regions, and a mask of the regions."""
+  margin = int(margin * image.shape[1])
+  bw = np.zeros(image.shape[:2], dtype=np.uint8)
+  prepared = np.zeros(image.shape[:2], dtype=bool)
+  for card in FindCards(image, width, count):
+    x0, y0 = max(card.x - margin, 0), max(card.y - margin, 0)
+    x1 = min(card.x + card.w + margin, image.shape[1])
+    y1 = min(card.y + card.h + margin, image.shape[0])
+    bw[y0:y1, x0:x1] = PrepareImage(image[y0:y1, x0:x1], params)
+    prepared[y0:y1, x0:x1] = True
+  return bw, prepared
+
+
+def PrepareCard(image, width=COARSE_WIDTH, margin=CARD_MARGIN,
+                params=DEFAULT_PARAMS, count=1):
+  """Converts the card's region of a color image to black and white, like
+  PrepareRegions. The rest of the frame is black."""
+  return PrepareRegions(image, width, margin, params, count)[0]
+
+
 def FindExternalContour(image_bw):
   """Returns the largest external contour."""
   # all external contours
@@ -83,17 +185,60 @@ def FindExternalContour(image_bw):
   return Rect(*cv2.boundingRect(largest))
 
 
-def FindInternalBox(bw):
-  """Finds where the puzzle card is located.
-
-  Detects all vertical and horizontal lines, and returns the largest
-  contour that bounds them"""
+def FindExternalContours(image_bw, count=None, min_size=0):
+  """Returns the bounding boxes of up to count of the largest external
+  contours that are at least min_size wide and high, largest first"""
+  _, contours, _ = cv2.findContours(image_bw.copy(), cv2.RETR_EXTERNAL,
+                                    cv2.CHAIN_APPROX_SIMPLE)
+  contours = sorted(contours, key=cv2.contourArea, reverse=True)
+  rects = [Rect(*cv2.boundingRect(c)) for c in contours]
+  return [r for r in rects if r.w >= min_size and r.h >= min_size][:count]
+
+
+def FindInternalBoxes(bw, params=DEFAULT_PARAMS, count=None):
+  """Finds where the puzzle boards are located.
+
+  Detects all vertical and horizontal lines, and returns up to count of the
+  largest boxes bounding lines that may be boards.
+
+  Every group of connected lines is a candidate, including ones inside
+  others. Of two nested candidates, the outer one is skipped when the inner
+  one covers at least a quarter of it, like the outline of a card lying on a
+  table around its board. Otherwise the inner one is, as it's within a board,
+  whose cells are a 16th of it."""
+  lines_image = FindLines(bw, params)
+  if lines_image is None:
+    return []
+  _, contours, hierarchy = cv2.findContours(lines_image, cv2.RETR_CCOMP,
+                                            cv2.CHAIN_APPROX_SIMPLE)
+  # The top level of the hierarchy are the outer boundaries of the groups
+  outer = [c for c, h in zip(contours, hierarchy[0]) if h[3] < 0]
+  rects = [Rect(*cv2.boundingRect(c))
+           for c in sorted(outer, key=cv2.contourArea, reverse=True)]
+  rects = [r for r in rects if r.w >= MIN_BOARD_SIZE and r.h >= MIN_BOARD_SIZE]
+
+  def Nested(r):
+    for o in rects:
+      if o != r and Contains(r, o) and o.w * o.h * 4 >= r.w * r.h:
+        return True
+      if o != r and Contains(o, r) and r.w * r.h * 4 < o.w * o.h:
+        return True
+    return False
+
+  return [r for r in rects if not Nested(r)][:count]
+
+
+def FindLines(bw, params=DEFAULT_PARAMS):
+  """Returns an image of the vertical and horizontal lines in bw, thickened
+  to merge the lines of a board, or None if there are none"""
 
   # Invert colors. HoughLines searches white lines on black background
   target = 255 - bw.copy()
   DebugShow(target)
 
-  lines = cv2.HoughLinesP(target, 1, np.pi / 180, 100, 100, 10)
+  lines = cv2.HoughLinesP(target, 1, np.pi / 180, params.hough_threshold,
+                          minLineLength=params.hough_min_length,
+                          maxLineGap=params.hough_max_gap)
   if lines is None:
     logging.debug("HoughLinesP failed")
     return None
@@ -111,26 +256,121 @@ def FindInternalBox(bw):
         y = min(y1, y2)
         cv2.line(lines_image, (x1, y), (x2, y), 255, 0)
 
-  kernel = np.ones((5, 5), np.uint8)
-  lines_image = cv2.dilate(lines_image, kernel, iterations=2)
+  kernel = np.ones((params.dilate_kernel, params.dilate_kernel), np.uint8)
+  lines_image = cv2.dilate(lines_image, kernel,
+                           iterations=params.dilate_iterations)
   DebugShow(lines_image)
-
-  return FindExternalContour(lines_image)
-
-
-def FindBoard(frame_bw):
-  outer = FindExternalContour(frame_bw)
-  logging.debug("Found game's outer box {0}".format(outer))
-
-  outer_img = Crop(frame_bw, outer)
-  inner = FindInternalBox(outer_img)
-  if not inner or inner.w < 100 or inner.h < 100:
-    logging.debug("Cound not find game's inner box")
-    return None
-
-  box = Rect(outer.x + inner.x, outer.y + inner.y, inner.w, inner.h)
-  logging.debug("Found board location in frame {0}".format(box))
-  return box
+  return lines_image
+
+
+def FindBoard(frame_bw, params=DEFAULT_PARAMS):
+  """Returns the location of the largest board in frame, or None"""
+  return (FindBoards(frame_bw, params, 1) or [None])[0]
+
+
+def FindBoards(frame_bw, params=DEFAULT_PARAMS, count=1):
+  """Returns the locations of up to count boards in frame.
+
+  Every external contour that may hold a board is searched for boards, from
+  the largest down. A contour may hold several boards, e.g. when the cards
+  lie on a bright table."""
+  boxes = []
+  for outer in FindExternalContours(frame_bw, min_size=MIN_BOARD_SIZE):
+    if len(boxes) >= count:
+      break
+    for inner in FindInternalBoxes(Crop(frame_bw, outer), params,
+                                   count - len(boxes)):
+      boxes.append(Rect(outer.x + inner.x, outer.y + inner.y, inner.w,
+                        inner.h))
+  logging.debug("Found {0} boards in frame {1}".format(len(boxes), boxes))
+  return boxes
+
+
+def EdgeResponse(frame_bw, box, margin, prepared=None):
+  """Returns how dark the box's edges are, and where.
+
+  For each of the left, right, top and bottom edges, returns the fraction of
+  black pixels along the darkest line parallel to it, up to margin pixels
+  inside the box (and a little outside of it), and that line's offset from
+  the edge. Pixels outside the frame, or outside the prepared mask when
+  given, aren't dark."""
+  x0, y0 = max(box.x - 2, 0), max(box.y - 2, 0)
+  x1 = min(box.x + box.w + 2, frame_bw.shape[1])
+  y1 = min(box.y + box.h + 2, frame_bw.shape[0])
+  if x0 >= x1 or y0 >= y1:
+    return [(0, 0)] * 4
+  dark = np.zeros((box.h + 4, box.w + 4), dtype=bool)
+  dark[y0 - box.y + 2:y1 - box.y + 2, x0 - box.x + 2:x1 - box.x + 2] = \
+      frame_bw[y0:y1, x0:x1] == 0
+  if prepared is not None:
+    dark[y0 - box.y + 2:y1 - box.y + 2, x0 - box.x + 2:x1 - box.x + 2] &= \
+        prepared[y0:y1, x0:x1]
+  bands = [dark[2:-2, :margin + 2].mean(axis=0),
+           dark[2:-2, -margin - 2:][:, ::-1].mean(axis=0),
+           dark[:margin + 2, 2:-2].mean(axis=1),
+           dark[-margin - 2:, 2:-2][::-1].mean(axis=1)]
+  return [(band.max(), band.argmax()) for band in bands]
+
+
+class BoardTracker(object):
+  """Tracks the boards' locations across frames.
+
+  Reuses the last locations while the darkest line along each of their edges
+  stays about as dark as when the boards were found, within max_offset
+  pixels of where it was. Falls back to FindBoards when they don't, which
+  happens when a card moves or is removed. While fewer boards than asked for
+  are tracked, it also searches again every search_interval frames, to
+  notice new cards. Boxes with an edge lighter than min_response aren't
+  tracked, as a light edge stays light wherever the card goes.
+
+  Pass the mask from PrepareRegions as prepared, so the black fill outside
+  the prepared regions doesn't look like the board's edges."""
+
+  def __init__(self, margin=8, tolerance=0.75, min_response=0.5,
+               max_offset=2, search_interval=10, params=DEFAULT_PARAMS):
+    self.margin = margin
+    self.tolerance = tolerance
+    self.min_response = min_response
+    self.max_offset = max_offset
+    self.search_interval = search_interval
+    self.params = params
+    self.boxes = []
+    self.references = []
+    self.since_search = 0
+    self.tracked = 0
+    self.detected = 0
+
+  def Tracks(self, frame_bw, box, reference, prepared=None):
+    if min(ref for ref, _ in reference) < self.min_response:
+      return False
+    response = EdgeResponse(frame_bw, box, self.margin, prepared)
+    if all(r >= self.tolerance * ref and abs(offset - ref_offset) <=
+           self.max_offset
+           for (r, offset), (ref, ref_offset) in zip(response, reference)):
+      return True
+    logging.debug("Lost board at {0}".format(box))
+    return False
+
+  def FindBoards(self, frame_bw, count=1, prepared=None):
+    self.since_search += 1
+    if (self.boxes and
+        (len(self.boxes) >= count or
+         self.since_search < self.search_interval) and
+        all(self.Tracks(frame_bw, box, reference, prepared)
+            for box, reference in zip(self.boxes, self.references))):
+      self.tracked += 1
+      return self.boxes
+
+    self.detected += 1
+    self.since_search = 0
+    self.boxes = FindBoards(frame_bw, self.params, count)
+    self.references = [EdgeResponse(frame_bw, box, self.margin, prepared)
+                       for box in self.boxes]
+    return self.boxes
+
+  def FindBoard(self, frame_bw, prepared=None):
+    boxes = self.FindBoards(frame_bw, prepared=prepared)
+    return boxes[0] if boxes else None
 
 
 def ReadCells(frame, box):
@@ -158,11 +398,8 @@ def LoadTemplates():
     templates = [cv2.cvtColor(t, cv2.COLOR_RGB2GRAY) for t in templates]
     return templates
 
-  return dict([(o, ReadTemplates("obj", o))
-               for o in [board.SquareType.UP, board.SquareType.RIGHT,
-                         board.SquareType.DOWN, board.SquareType.LEFT,
-                         board.SquareType.ANY]] + [(c, ReadTemplates("con", c))
-                                                   for c in Constraint])
+  return dict([(o, ReadTemplates("obj", o)) for o in OBJECTS] +
+              [(c, ReadTemplates("con", c)) for c in Constraint])
 
 
 def MatchTemplate(template, target):
@@ -172,36 +409,44 @@ def MatchTemplate(template, target):
   return max_val
 
 
-def DetectObjects(templates, cells):
+def BestMatch(templates, types, target):
+  """Returns the type whose templates match target best, and the score"""
+  matches = [(o, MatchTemplate(t, target)) for o in types
+             for t in templates[o]]
+  return max(matches, key=operator.itemgetter(1))
+
+
+def MatchObjects(templates, cells, params=DEFAULT_PARAMS):
+  """Returns the detected objects and the best template score of each cell"""
   objects = np.array([None] * 16, dtype='O').reshape(4, 4)
+  scores = np.zeros((4, 4))
   for selected in itertools.product(range(4), range(4)):
     target = cells[selected].copy()
     DebugShow(target)
 
-    matches = [(o, MatchTemplate(t, target))
-               for o in [board.SquareType.UP, board.SquareType.RIGHT,
-                         board.SquareType.DOWN, board.SquareType.LEFT,
-                         board.SquareType.ANY] for t in templates[o]]
-    best = max(matches, key=operator.itemgetter(1))
-    if best[1] < 0.6:
+    best = BestMatch(templates, OBJECTS, target)
+    scores[selected] = best[1]
+    if best[1] < params.min_score:
       continue
 
     logging.debug("Detected {0} with score {1} at {2}".format(best[0], best[1],
                                                               selected))
     objects[selected] = best[0]
-  return objects
+  return objects, scores
 
 
-def DetectConstraints(templates, cells):
+def DetectObjects(templates, cells, params=DEFAULT_PARAMS):
+  return MatchObjects(templates, cells, params)[0]
+
+
+def DetectConstraints(templates, cells, params=DEFAULT_PARAMS):
   constraints = np.array([None] * 16, dtype='O').reshape(4, 4)
   for selected in itertools.product(range(4), range(4)):
     target = cells[selected].copy()
     DebugShow(target)
 
-    matches = [(o, MatchTemplate(t, target))
-               for o in Constraint for t in templates[o]]
-    best = max(matches, key=operator.itemgetter(1))
-    if best[1] < 0.6:
+    best = BestMatch(templates, Constraint, target)
+    if best[1] < params.min_score:
       continue
 
     logging.debug("Detected {0} with score {1} at {2}".format(best[0], best[1],
@@ -210,30 +455,93 @@ def DetectConstraints(templates, cells):
   return constraints
 
 
+def Classify(scores, min_score=MIN_SCORE):
+  """Returns the object, the object's score and the constraint given the
+  template scores of a cell"""
+  obj = max(OBJECTS, key=scores.get)
+  constraint = max(Constraint, key=scores.get)
+  return (obj if scores[obj] >= min_score else None, scores[obj],
+          constraint if scores[constraint] >= min_score else None)
+
+
+def Recognize(matcher, cells, cache=None, params=DEFAULT_PARAMS):
+  """Returns the objects, their scores and the constraints of all cells.
+
+  All the cells are matched against all the templates by a
+  matching.TemplateMatcher in one pass. With a cell_cache.CellCache only
+  the cells that changed since they were last recognized are matched."""
+  return RecognizeBoards(matcher, [cells], cache, params)[0]
+
+
+def RecognizeBoards(matcher, boards, cache=None, params=DEFAULT_PARAMS):
+  """Like Recognize, for the cells of several boards.
+
+  The cells of all the boards are matched in the same pass, so the
+  matcher's threads work on all of them at once."""
+  keys = [(b,) + selected for b in range(len(boards))
+          for selected in itertools.product(range(4), range(4))]
+  results = {}
+  fingerprints = {}
+  for key in keys:
+    if cache:
+      fingerprints[key] = cell_cache.Fingerprint(boards[key[0]][key[1:]])
+      results[key] = cache.Get(key, fingerprints[key])
+
+  changed = [k for k in keys if not results.get(k)]
+  for key, scores in zip(changed, matcher.Match([boards[k[0]][k[1:]]
+                                                 for k in changed])):
+    results[key] = Classify(scores, params.min_score)
+    if cache:
+      cache.Put(key, fingerprints[key], results[key])
+
+  recognized = []
+  for b in range(len(boards)):
+    objects = np.array([None] * 16, dtype='O').reshape(4, 4)
+    scores = np.zeros((4, 4))
+    constraints = np.array([None] * 16, dtype='O').reshape(4, 4)
+    for selected in itertools.product(range(4), range(4)):
+      key = (b,) + selected
+      objects[selected], scores[selected], constraints[selected] = \
+          results[key]
+      if key in changed and (objects[selected] or constraints[selected]):
+        logging.debug("Detected {0} with score {1} and {2} at {3}".format(
+            objects[selected], scores[selected], constraints[selected], key))
+    recognized.append((objects, scores, constraints))
+  return recognized
+
+
 def PassConstraints(constraints, solution):
   b = solutions.PlacePieces(solution)
+  vertical = b[board.SquareType.UP.value] | b[board.SquareType.DOWN.value]
+  horizontal = b[board.SquareType.LEFT.value] | b[board.SquareType.RIGHT.value]
   for selected in itertools.product(range(4), range(4)):
-    loc = np.array([1, 1]) + selected
-    if constraints[selected] is Constraint.VERTICAL:
-      if b[zip(loc)] not in [board.SquareType.UP, board.SquareType.DOWN,
-                             board.SquareType.AIR]:
-        return False
-    if constraints[selected] is Constraint.HORIZONTAL:
-      if b[zip(loc)] not in [board.SquareType.LEFT, board.SquareType.RIGHT,
-                             board.SquareType.AIR]:
-        return False
+    bit = board.Bit(selected[0] + 1, selected[1] + 1)
+    if constraints[selected] is Constraint.VERTICAL and horizontal & bit:
+      return False
+    if constraints[selected] is Constraint.HORIZONTAL and vertical & bit:
+      return False
   return True
 
 
+def ConstraintMasks(constraints):
+  """Returns masks of the squares with VERTICAL and HORIZONTAL constraints"""
+  masks = dict((c, 0) for c in Constraint)
+  for selected in itertools.product(range(4), range(4)):
+    if constraints[selected]:
+      masks[constraints[selected]] |= board.Bit(selected[0] + 1,
+                                                selected[1] + 1)
+  return masks[Constraint.VERTICAL], masks[Constraint.HORIZONTAL]
+
+
 def BuildPuzzleBoardFromObjects(objects):
-  """Build 6x6 board and fills in the objects"""
-  b = board.Empty()
+  """Build 6x6 bitboard and fills in the objects"""
+  bits = list(board.EmptyBits())
   for selected in itertools.product(range(4), range(4)):
-    loc = np.array([1, 1]) + selected
     if objects[selected]:
-      b[zip(loc)] = objects[selected]
+      bits[objects[selected].value] |= board.Bit(selected[0] + 1,
+                                                 selected[1] + 1)
 
-  return b
+  return tuple(bits)
 
 
 def LoadImages():
@@ -248,36 +556,82 @@ def LoadImages():
                          board.SquareType.DOWN, board.SquareType.LEFT]])
 
 
-def ShowSolution(images, puzzle, solution, frame, box):
-  cell_size = np.array([box.w / 4, box.h / 4])
-  for piece_type, piece, i, j in solution:
-    top_left_loc = np.array([box.x, box.y]) + (np.array([j, i]) -
-                                               np.array([1, 1])) * cell_size
-    color = pieces.Colors[piece_type]
-    piece_img = np.zeros_like(frame)
-    for square in itertools.product(range(2), range(2)):
-      if piece[square] == board.SquareType.AIR:
+class Renderer(object):
+  """Draws solutions over the board.
+
+  Every piece, in each of its orientations, is drawn once per cell size to
+  a sprite just large enough to hold it and its outline. Solutions are
+  drawn by blending the sprites into the frame at the pieces' locations."""
+
+  # Pixels around a piece its outline may cover
+  MARGIN = 2
+
+  def __init__(self, images):
+    self.images = images
+    self.sprites = {}
+
+  def Sprite(self, placement, cell_size):
+    """Returns the sprite of placement's piece and orientation"""
+    key = (placement.piece_type, placement.orientation, tuple(cell_size))
+    if key in self.sprites:
+      return self.sprites[key]
+
+    shape = 2 * cell_size[::-1] + 1 + 2 * self.MARGIN
+    sprite = np.zeros((shape[0], shape[1], 3), dtype=np.uint8)
+    for (i, j), square_type in board.Squares(placement.bits):
+      loc = self.MARGIN + np.array([j - placement.j, i - placement.i
+                                   ]) * cell_size
+      cv2.rectangle(sprite, tuple(loc), tuple(loc + cell_size),
+                    pieces.Colors[placement.piece_type], -2)
+      if square_type in self.images:
+        image = cv2.resize(self.images[square_type], tuple(cell_size))
+        roi = sprite[loc[1]:loc[1] + cell_size[1], loc[0]:loc[0] +
+                     cell_size[0]]
+        roi[:] = cv2.add(roi, image)
+
+    gray = cv2.cvtColor(sprite, cv2.COLOR_RGB2GRAY)
+    _, gray = cv2.threshold(gray, 10, 255, cv2.THRESH_BINARY)
+    _, contours, _ = cv2.findContours(gray, cv2.RETR_EXTERNAL,
+                                      cv2.CHAIN_APPROX_SIMPLE)
+    cv2.drawContours(sprite, contours, -1, (255, 255, 255), 3)
+
+    self.sprites[key] = sprite
+    return sprite
+
+  def Render(self, solution, frame, box):
+    """Returns a copy of frame with the pieces of solution drawn over box"""
+    return self.RenderAll([(solution, box)], frame)
+
+  def RenderAll(self, solved, frame):
+    """Returns a copy of frame with every (solution, box) in solved drawn"""
+    frame = frame.copy()
+    for solution, box in solved:
+      self.Draw(solution, frame, box)
+    return frame
+
+  def Draw(self, solution, frame, box):
+    """Draws the pieces of solution over box in frame"""
+    cell_size = np.array([box.w / 4, box.h / 4])
+    for location in solution:
+      placement = pieces.FindPlacement(location)
+      sprite = self.Sprite(placement, cell_size)
+      x, y = np.array([box.x, box.y]) + np.array(
+          [placement.j - 1, placement.i - 1]) * cell_size - self.MARGIN
+
+      # Clip the sprite to the frame
+      x0, y0 = max(x, 0), max(y, 0)
+      x1 = min(x + sprite.shape[1], frame.shape[1])
+      y1 = min(y + sprite.shape[0], frame.shape[0])
+      if x0 >= x1 or y0 >= y1:
         continue
+      roi = frame[y0:y1, x0:x1]
+      roi[:] = cv2.addWeighted(roi, 1.0, sprite[y0 - y:y1 - y, x0 - x:x1 - x],
+                               0.7, 0)
 
-      loc = top_left_loc + np.array(square[::-1]) * cell_size
-      piece_img = cv2.rectangle(piece_img, tuple(loc), tuple(loc + cell_size),
-                                color, -2)
 
-      if piece[square] in images:
-        image = cv2.resize(images[piece[square]], tuple(cell_size))
-        blend = np.zeros_like(piece_img)
-        blend[loc[1]:loc[1] + cell_size[1], loc[0]:loc[0] + cell_size[
-            0]] = image
-        piece_img = cv2.addWeighted(piece_img, 1.0, blend, 1.0, 0)
-
-    piece_gray = cv2.cvtColor(piece_img, cv2.COLOR_RGB2GRAY)
-    _, piece_gray = cv2.threshold(piece_gray, 10, 255, cv2.THRESH_BINARY)
-    _, contours, _ = cv2.findContours(piece_gray, cv2.RETR_EXTERNAL,
-                                      cv2.CHAIN_APPROX_SIMPLE)
-    piece_img = cv2.drawContours(piece_img, contours, -1, (255, 255, 255), 3)
-
-    frame = cv2.addWeighted(frame, 1.0, piece_img, 0.7, 0)
-    cv2.imshow("Planes", frame)
+def ShowSolutions(renderer, solved, frame):
+  """Shows the (solution, box) pairs in solved over frame"""
+  cv2.imshow("Planes", renderer.RenderAll(solved, frame))
 
 
 def main():
@@ -288,6 +642,68 @@ def main():
     parser.add_argument("--image",
                         type=str,
                         help="Process input image. Using video camera insead")
+    parser.add_argument("--config",
+                        type=str,
+                        help="JSON file of detection parameters, as written "
+                        "by tune.py. Defaults to the built in ones")
+    parser.add_argument("--once",
+                        action="store_true",
+                        help="Stop after the last of the --image files or "
+                        "video frames, instead of cycling through them")
+    parser.add_argument("--db",
+                        type=str,
+                        default=solution_db.DB_FILENAME,
+                        help="Solutions database file")
+    parser.add_argument("--direct",
+                        action="store_true",
+                        help="Search for the solutions of every puzzle "
+                        "instead of looking them up in the DB")
+    parser.add_argument("--async_capture",
+                        action="store_true",
+                        help="Capture camera frames on a background thread")
+    parser.add_argument("--track",
+                        action="store_true",
+                        help="Reuse the board location of previous frames")
+    parser.add_argument("--max_boards",
+                        type=int,
+                        default=1,
+                        help="Most cards to look for and solve in every frame")
+    parser.add_argument("--threads",
+                        type=int,
+                        help="Number of threads matching templates. Defaults "
+                        "to the number of CPUs")
+    parser.add_argument("--cell_size",
+                        type=int,
+                        default=matching.CELL_SIZE,
+                        help="Size to downscale larger cells to before "
+                        "matching. Templates are scaled to the cells. 0 "
+                        "matches cells and templates as they are")
+    parser.add_argument("--coarse_width",
+                        type=int,
+                        default=COARSE_WIDTH,
+                        help="Width to downscale frames to when locating the "
+                        "card. Only the card is preprocessed at full "
+                        "resolution. 0 preprocesses the whole frame")
+    parser.add_argument("--cache",
+                        action="store_true",
+                        help="Recognize only the cells that changed, and "
+                        "remember recent solutions")
+    parser.add_argument("--max_mismatches",
+                        type=int,
+                        default=0,
+                        help="Squares a solution may differ from the detected "
+                        "board in, when there is no exact solution. Ignored "
+                        "with --direct")
+    parser.add_argument("--metrics_interval",
+                        type=float,
+                        default=0,
+                        help="Seconds between logging stage latencies and "
+                        "counters. 0 disables")
+    parser.add_argument("--metrics_port",
+                        type=int,
+                        default=0,
+                        help="Serve metrics for Prometheus on this localhost "
+                        "port. 0 disables")
     parser.add_argument("-v",
                         "--verbose",
                         action="store_true",
@@ -299,54 +715,133 @@ def main():
       logging.getLogger('').handlers = []
       logging.basicConfig(level=logging.DEBUG)
 
+    source = None
+    matcher = None
+    server = None
     try:
-      loader = solutions.AsyncLoader()
-      loader.start()
+      if Options.metrics_interval or Options.metrics_port:
+        stats = metrics.Metrics(Options.metrics_interval)
+      else:
+        stats = metrics.NullMetrics()
+      if Options.metrics_port:
+        server = metrics.MetricsServer(stats, Options.metrics_port)
+
+      params = LoadParams(Options.config) if Options.config else DEFAULT_PARAMS
+      logging.debug("Detection parameters: {0}".format(params))
+      db = None if Options.direct else solution_db.SolutionDB(Options.db)
+      partial_index = None
 
       if Options.image:
-        source = image_source.FileSource(Options.image)
+        source = image_source.FileSource(Options.image,
+                                         loop=not Options.once)
+        if Options.async_capture:
+          logging.info("Ignoring --async_capture, files are already read on "
+                       "a background thread")
       else:
         source = image_source.CameraSource()
+        if Options.async_capture:
+          source = image_source.AsyncSource(source)
 
       templates = LoadTemplates()
-      images = LoadImages()
+      matcher = matching.TemplateMatcher(templates, Options.threads,
+                                         Options.cell_size)
+      renderer = Renderer(LoadImages())
+      tracker = BoardTracker(params=params) if Options.track else None
+      cells_cache = cell_cache.CellCache() if Options.cache else None
+      lookups = cell_cache.LRUCache() if Options.cache else None
+      recognized = 0
 
       while True:
-        frame = source.NextFrame()
+        stats.Frame()
+        with stats.Stage("capture"):
+          frame = source.NextFrame()
+        if frame is None:
+          logging.info("No more frames")
+          break
         cv2.imshow("Planes", frame)
 
-        frame_bw = PrepareImage(frame)
-
-        box = FindBoard(frame_bw)
-        if not box:
+        with stats.Stage("preprocess"):
+          if Options.coarse_width:
+            frame_bw, prepared = PrepareRegions(
+                frame, Options.coarse_width, params=params,
+                count=Options.max_boards)
+          else:
+            frame_bw, prepared = PrepareImage(frame, params), None
+
+        with stats.Stage("find_board"):
+          if tracker:
+            boxes = tracker.FindBoards(frame_bw, Options.max_boards,
+                                       prepared)
+          else:
+            boxes = FindBoards(frame_bw, params, Options.max_boards)
+        if not boxes:
+          stats.Count("board_not_found")
           WaitKey(5)
           continue
-
-        cells = ReadCells(frame_bw, box)
-        objects = DetectObjects(templates, cells)
-        constraints = DetectConstraints(templates, cells)
-
-        puzzle = BuildPuzzleBoardFromObjects(objects)
-        if Options.verbose:
-          board.Print(puzzle)
-
-        loader.join()
-        matches = loader.db["board_to_solution"][hash(str(puzzle))]
-        if not matches:
+        stats.Count("boards_found", len(boxes))
+
+        with stats.Stage("recognize"):
+          recognized_boards = RecognizeBoards(matcher, [ReadCells(frame_bw, box)
+                                                        for box in boxes],
+                                              cells_cache, params)
+        stats.Count("cells_recognized", matcher.cells - recognized)
+        recognized = matcher.cells
+
+        solved = []
+        for box, (objects, scores, constraints) in zip(boxes,
+                                                       recognized_boards):
+          puzzle = BuildPuzzleBoardFromObjects(objects)
+          if Options.verbose:
+            board.Print(board.FromBits(puzzle))
+
+          masks = ConstraintMasks(constraints)
+          lookup_key = (board.Key(puzzle),) + masks
+          matches = lookups.Get(lookup_key) if lookups else None
+          if matches is None:
+            with stats.Stage("lookup"):
+              if db:
+                matches = solutions.Lookup(db, puzzle, *masks)
+              else:
+                matches = solutions.SolvePuzzle(puzzle, *masks)
+            stats.Count("db_hits" if matches else "db_misses")
+            if not matches and db and Options.max_mismatches:
+              with stats.Stage("partial_lookup"):
+                if not partial_index:
+                  partial_index = solutions.PartialIndex(db)
+                matches = partial_index.Lookup(puzzle, scores,
+                                               Options.max_mismatches, *masks)
+            if lookups:
+              lookups.Put(lookup_key, matches)
+          else:
+            stats.Count("lookup_cache_hits")
+          if not matches:
+            stats.Count("puzzle_not_found")
+            logging.debug("Puzzle at {0} not found in solutions DB".format(
+                box))
+            continue
+
+          logging.debug("Found {0} solutions within constraints at {1}".format(
+              len(matches), box))
+          solved.append((box, matches))
+        if not solved:
           WaitKey(5)
-          logging.debug("Puzzle not found in solutions DB")
           continue
 
-        logging.debug("Found {0} solutions in DB".format(len(matches)))
-        matches = [m for m in matches if PassConstraints(constraints, m)]
-
-        logging.debug("Found {0} solutions within constraints".format(len(
-            matches)))
-        for m in matches:
-          ShowSolution(images, puzzle, m, frame, box)
+        # Step through the solutions of all the boards together. Boards with
+        # fewer solutions keep showing their last one.
+        for n in range(max(len(matches) for _, matches in solved)):
+          with stats.Stage("render"):
+            ShowSolutions(renderer, [(matches[min(n, len(matches) - 1)], box)
+                                     for box, matches in solved], frame)
           WaitKey(0)
 
     finally:
+      if source:
+        source.Close()
+      if matcher:
+        matcher.Close()
+      if server:
+        server.Close()
       logging.debug("Destroying windows")
       cv2.destroyAllWindows()
 
@@ -0,0 +1,317 @@
+#!/usr/local/bin/python
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import cv2
+import json
+import time
+import random
+import logging
+import argparse
+import traceback
+import collections
+import multiprocessing
+import numpy as np
+import solver
+import matching
+import batch
+
+LABELS_FILENAME = "samples/labels.json"
+CONFIG_FILENAME = "params.json"
+
+# Values every solver.Params field is picked from
+SEARCH_SPACE = collections.OrderedDict([
+    ("bilateral_diameter", [3, 5, 7, 9, 11]),
+    ("bilateral_sigma", [25, 50, 75, 100, 150]),
+    ("threshold_block", [7, 9, 11, 15, 21]),
+    ("threshold_c", [0, 1, 2, 3, 5]),
+    ("hough_threshold", [50, 75, 100, 150, 200]),
+    ("hough_min_length", [5, 10, 20, 40]),
+    ("hough_max_gap", [0, 2, 5, 10]),
+    ("dilate_kernel", [3, 5, 7]),
+    ("dilate_iterations", [1, 2, 3]),
+    ("min_score", [0.5, 0.55, 0.6, 0.65, 0.7]),
+])
+
+Result = collections.namedtuple("Result",
+                                ["params", "latency", "accuracy", "exact"])
+
+# The Evaluator of this process
+evaluator = None
+
+
+def Candidates(trials, seed=0):
+  """Returns the defaults followed by up to trials - 1 distinct random
+  picks from SEARCH_SPACE"""
+  rand = random.Random(seed)
+  candidates = [solver.DEFAULT_PARAMS]
+  seen = set(candidates)
+  for _ in range(trials * 10):
+    if len(candidates) >= trials:
+      break
+    params = solver.Params(**dict((k, rand.choice(v))
+                                  for k, v in SEARCH_SPACE.iteritems()))
+    if params not in seen:
+      seen.add(params)
+      candidates.append(params)
+  return candidates
+
+
+def ParetoFront(results):
+  """Returns the results that no other result is both as fast and as
+  accurate as, fastest first"""
+  front = []
+  for result in sorted(results, key=lambda r: (r.latency, -r.accuracy)):
+    if not front or result.accuracy > front[-1].accuracy:
+      front.append(result)
+  return front
+
+
+def Choose(front, min_accuracy):
+  """Returns the fastest result at least min_accuracy accurate, or the most
+  accurate one if there's none"""
+  for result in front:
+    if result.accuracy >= min_accuracy:
+      return result
+  return front[-1]
+
+
+def Accuracy(detected, label):
+  """Returns the fraction of the label's squares and constraints detected"""
+  if not detected:
+    return 0.0
+  matches = [a == b for key in ("puzzle", "constraints")
+             for row, expected in zip(detected[key], label[key])
+             for a, b in zip(row, expected)]
+  return float(sum(matches)) / len(matches)
+
+
+class Evaluator(object):
+  """Runs the detection pipeline on labeled frames with different Params.
+
+  The frames are decoded and scaled once. Every frame is run repeat times
+  and its fastest run counts, as other processes compete for the CPUs."""
+
+  def __init__(self, labels, scale=1.0, cell_size=matching.CELL_SIZE,
+               coarse_width=solver.COARSE_WIDTH, repeat=3):
+    self.frames = []
+    for filename, label in sorted(labels.iteritems()):
+      frame = cv2.imread(filename)
+      assert frame is not None, "Could not read {0}".format(filename)
+      if scale != 1:
+        frame = matching.Resize(frame, scale)
+      self.frames.append((frame, label))
+    self.matcher = matching.TemplateMatcher(solver.LoadTemplates(), 1,
+                                            cell_size)
+    self.coarse_width = coarse_width
+    self.repeat = repeat
+
+  def Detect(self, frame, params):
+    """Returns the batch.Board detected in frame, or None"""
+    if self.coarse_width:
+      frame_bw = solver.PrepareCard(frame, self.coarse_width, params=params)
+    else:
+      frame_bw = solver.PrepareImage(frame, params)
+    box = solver.FindBoard(frame_bw, params)
+    if not box:
+      return None
+    cells = solver.ReadCells(frame_bw, box)
+    objects, _, constraints = solver.Recognize(self.matcher, cells,
+                                               params=params)
+    return batch.Board(solver.BuildPuzzleBoardFromObjects(objects),
+                       constraints)
+
+  def Evaluate(self, params):
+    latencies = []
+    accuracies = []
+    for frame, label in self.frames:
+      fastest = float("inf")
+      for _ in range(self.repeat):
+        start = time.time()
+        try:
+          detected = self.Detect(frame, params)
+        except Exception:
+          logging.debug(traceback.format_exc())
+          detected = None
+        fastest = min(fastest, time.time() - start)
+      latencies.append(fastest * 1000)
+      accuracies.append(Accuracy(detected, label))
+    return Result(params, np.mean(latencies), np.mean(accuracies),
+                  sum(a == 1 for a in accuracies))
+
+
+def InitEvaluator(*args):
+  global evaluator
+  evaluator = Evaluator(*args)
+
+
+def Evaluate(params):
+  return evaluator.Evaluate(params)
+
+
+def Tune(candidates, found, jobs=1, evaluator_args=()):
+  """Calls found with the Result of every candidate, as they finish"""
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs, InitEvaluator, evaluator_args)
+    try:
+      for result in pool.imap_unordered(Evaluate, candidates):
+        found(result)
+    finally:
+      pool.terminate()
+  else:
+    InitEvaluator(*evaluator_args)
+    for params in candidates:
+      found(Evaluate(params))
+
+
+def Label(filenames, params, cell_size, coarse_width):
+  """Returns the boards detected in the images, to be reviewed as labels"""
+  labels = collections.OrderedDict()
+  labeler = Evaluator({}, cell_size=cell_size, coarse_width=coarse_width)
+  try:
+    for filename in filenames:
+      detected = labeler.Detect(cv2.imread(filename), params)
+      if detected:
+        labels[filename] = detected
+      else:
+        logging.warning("No board found in {0}".format(filename))
+  finally:
+    labeler.matcher.Close()
+  return labels
+
+
+def Print(front, chosen):
+  fields = SEARCH_SPACE.keys()
+  print "{0:>10}{1:>10}{2:>7}  {3}".format("ms/frame", "accuracy", "exact",
+                                           " ".join(fields))
+  for result in front:
+    print "{0:>10.2f}{1:>10.1%}{2:>7}  {3}{4}".format(
+        result.latency, result.accuracy, result.exact,
+        " ".join(str(getattr(result.params, f)) for f in fields),
+        "  <- chosen" if result is chosen else "")
+
+
+def main():
+  try:
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--labels",
+                        type=str,
+                        default=LABELS_FILENAME,
+                        help="JSON file of the frames to tune on and their "
+                        "boards")
+    parser.add_argument("--label",
+                        nargs="+",
+                        metavar="IMAGES",
+                        help="Write the boards detected in these directories "
+                        "or globs of images to --labels, to be reviewed, "
+                        "instead of tuning")
+    parser.add_argument("--trials",
+                        type=int,
+                        default=200,
+                        help="Number of parameter sets to try")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="Seed of the random parameter search")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of processes to try parameters with")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=3,
+                        help="Runs of every frame, of which the fastest counts")
+    parser.add_argument("--scale",
+                        type=float,
+                        default=1.0,
+                        help="Scale the frames by this much first, to tune "
+                        "for lower resolution cameras")
+    parser.add_argument("--cell_size",
+                        type=int,
+                        default=matching.CELL_SIZE,
+                        help="Size to downscale larger cells to before "
+                        "matching. 0 matches cells as they are")
+    parser.add_argument("--coarse_width",
+                        type=int,
+                        default=solver.COARSE_WIDTH,
+                        help="Width to downscale frames to when locating the "
+                        "card. 0 preprocesses the whole frame")
+    parser.add_argument("--min_accuracy",
+                        type=float,
+                        default=1.0,
+                        help="Choose the fastest parameters at least this "
+                        "accurate")
+    parser.add_argument("--output",
+                        type=str,
+                        default=CONFIG_FILENAME,
+                        help="File to write the chosen parameters to, for "
+                        "solver.py --config")
+    parser.add_argument("-v",
+                        "--verbose",
+                        action="store_true",
+                        help="Enable debug prints")
+
+    args = parser.parse_args()
+    if args.verbose:
+      logging.getLogger('').handlers = []
+      logging.basicConfig(level=logging.DEBUG)
+
+    if args.label:
+      labels = Label(batch.Filenames(args.label), solver.DEFAULT_PARAMS,
+                     args.cell_size, args.coarse_width)
+      with open(args.labels, "w") as f:
+        json.dump(labels, f, indent=2, separators=(",", ": "))
+      logging.info("Wrote {0} labels to {1}. Check them before tuning".format(
+          len(labels), args.labels))
+      return
+
+    with open(args.labels) as f:
+      labels = json.load(f)
+    assert labels, "No labeled frames"
+
+    candidates = Candidates(args.trials, args.seed)
+    results = []
+    start = time.time()
+
+    def Found(result):
+      results.append(result)
+      if len(results) % 10 == 0 or len(results) == len(candidates):
+        logging.info("Tried {0} of {1} parameter sets in {2:.1f}s".format(
+            len(results), len(candidates), time.time() - start))
+
+    Tune(candidates, Found, args.jobs,
+         (labels, args.scale, args.cell_size, args.coarse_width, args.repeat))
+
+    front = ParetoFront(results)
+    chosen = Choose(front, args.min_accuracy)
+    Print(front, chosen)
+    default = [r for r in results if r.params == solver.DEFAULT_PARAMS][0]
+    logging.info("Defaults: {0:.2f}ms/frame, {1:.1%} accurate".format(
+        default.latency, default.accuracy))
+
+    solver.SaveParams(chosen.params, args.output)
+    logging.info("Wrote the chosen parameters to {0}".format(args.output))
+    if chosen.accuracy < args.min_accuracy:
+      return "No parameters are {0:.1%} accurate".format(args.min_accuracy)
+
+  except Exception, e:
+    logging.error(traceback.format_exc())
+    return e
+
+
+if __name__ == "__main__":
+  sys.exit(main())